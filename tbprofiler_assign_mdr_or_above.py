@@ -6,55 +6,22 @@ import json
 import argparse
 import os
 from collections import defaultdict
-from tqdm import tqdm
-import pathogenprofiler as pp
-import tbprofiler as tbprofiler
+from tbprofiler_utils import get_samples, load_results, add_loader_args, get_resistant_drugs, get_resistance_matrix, assign_dr_classes, DR_CLASS_SCHEMES
 
 def main(args):
-    bed_file = "%s/share/tbprofiler/%s.bed" % (sys.base_prefix,args.db)
-    locus_tag2drugs = tbprofiler.get_lt2drugs(bed_file)
+    samples = get_samples(args.samples,args.dir,args.suffix)
+    schemes = args.schemes.split(",")
 
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
-    else:
-        samples = [x.replace(args.suffix,"") for x in os.listdir(args.dir) if x[-len(args.suffix):]==args.suffix]
-
-    FLQ_set = set(["moxifloxacin","levofloxacin","ciprofloxacin","ofloxacin"])
-    SLI_set = set(["amikacin","capreomycin","kanamycin"])
+    # Build the sample x drug resistance matrix in one pass and classify all samples at once
+    resistant_drugs = [drugs for s,drugs in load_results(samples,args.dir,args.suffix,extract=get_resistant_drugs,workers=args.workers)]
+    matrix,drugs = get_resistance_matrix(resistant_drugs)
+    classes = assign_dr_classes(matrix,drugs,schemes)
 
     OUT = open(args.out,"w")
-    writer = csv.DictWriter(OUT, fieldnames = ["sample","MDR"])
-    writer.writeheader()
-
-    for s in tqdm(samples):
-        data = json.load(open(pp.filecheck("%s/%s%s" % (args.dir,s,args.suffix))))
-        resistant_drugs = set()
-        for var in data["dr_variants"]:
-            for d in var["drugs"]:
-                resistant_drugs.add(d["drug"])
-
-
-
-        rif = "rifampicin" in resistant_drugs
-        inh = "isoniazid" in resistant_drugs
-        flq = len(FLQ_set.intersection(resistant_drugs)) > 0
-        sli = len(SLI_set.intersection(resistant_drugs)) > 0
-
-        if len(resistant_drugs)==0:
-            drtype = "0"
-        elif (rif and not inh) or (inh and not rif):
-            drtype = "0"
-        elif (rif and inh) and (not flq and not sli):
-            drtype = "1"
-        elif (rif and inh) and ( (flq and not sli) or (sli and not flq) ):
-            drtype = "1"
-        elif (rif and inh) and (flq and sli):
-            drtype = "1"
-        else:
-            drtype = "0"
-
-        writer.writerow({"sample":s, "MDR":drtype})
-
+    writer = csv.writer(OUT)
+    writer.writerow(["sample"] + [DR_CLASS_SCHEMES[scheme][0] for scheme in schemes])
+    for i,s in enumerate(samples):
+        writer.writerow([s] + [classes[scheme][i] for scheme in schemes])
     OUT.close()
 
 parser = argparse.ArgumentParser(description='tbprofiler script',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -63,6 +30,8 @@ parser.add_argument('--samples', type=str, help='File with samples')
 parser.add_argument('--dir', default="results/", type=str, help='Directory containing results')
 parser.add_argument('--db', default="tbdb", type=str, help='Database name')
 parser.add_argument('--suffix', default=".results.json", type=str, help='File suffix')
+parser.add_argument('--schemes', default="mdr_or_above", type=str, help='Comma separated classification schemes to output, one column each (%s)' % ", ".join(DR_CLASS_SCHEMES))
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
@@ -0,0 +1,36 @@
+#! /usr/bin/env python
+
+# Load useful libraries
+import argparse
+import sys
+import csv
+from collections import Counter
+from tbprofiler_utils import get_catalogue
+
+
+def main(args):
+    # Updates the cached catalogue used by all scripts and fills in the schema
+    # version of the files which have been added or changed since the last run
+    entries = get_catalogue(args.dir,args.suffix,versions=True,workers=args.workers)
+    if args.out:
+        with open(args.out,"w") as O:
+            writer = csv.writer(O,delimiter="\t")
+            writer.writerow(["sample","path","size","mtime","schema_version"])
+            for sample,path,size,mtime,version in entries:
+                writer.writerow([sample,path,size,mtime/1e9,version])
+    counts = Counter(e[4] for e in entries)
+    sys.stderr.write("%s samples\n" % len(entries))
+    for version in sorted(counts):
+        sys.stderr.write("schema version %s: %s\n" % (version,counts[version]))
+
+
+# Set up the parser
+parser = argparse.ArgumentParser(description='Update the sample catalogue of a results directory',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--dir',default="results/",type=str,help='Directory containing results')
+parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+parser.add_argument('--out',type=str,help='Also write the catalogue to this TSV file')
+parser.add_argument('--workers',default=1,type=int,help='Number of processes used to read the schema versions')
+parser.set_defaults(func=main)
+
+args = parser.parse_args()
+args.func(args)
@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+
+# Single entry point for all tbprofiler_*.py scripts, e.g.
+#
+#   tbprofiler_cli.py collate --dir results/ --outfile collated.tsv
+#
+# Each subcommand runs the matching tbprofiler_<command>.py script, so only
+# the modules used by that script are imported. Use --import-times to get a
+# breakdown of the time spent importing modules.
+import sys
+import os
+import time
+
+start_time = time.perf_counter()
+script_dir = os.path.dirname(os.path.abspath(__file__))
+not_commands = {"utils","cli"}
+
+
+def get_commands():
+    commands = {}
+    for f in os.listdir(script_dir):
+        if f.startswith("tbprofiler_") and f.endswith(".py"):
+            name = f[len("tbprofiler_"):-len(".py")]
+            if name not in not_commands:
+                commands[name] = os.path.join(script_dir,f)
+    return commands
+
+
+class ImportTimer:
+    # Wraps builtins.__import__ and records the time taken by every top-level
+    # import statement. Nested imports are included in the time of the import
+    # that triggered them.
+    def __init__(self):
+        self.times = {}
+        self.depth = 0
+
+    def install(self):
+        import builtins
+        original_import = builtins.__import__
+
+        def timed_import(name,globals=None,locals=None,fromlist=(),level=0):
+            if self.depth>0 or name in sys.modules:
+                return original_import(name,globals,locals,fromlist,level)
+            self.depth += 1
+            t = time.perf_counter()
+            try:
+                return original_import(name,globals,locals,fromlist,level)
+            finally:
+                self.times[name] = self.times.get(name,0) + time.perf_counter() - t
+                self.depth -= 1
+
+        builtins.__import__ = timed_import
+
+    def report(self):
+        total = time.perf_counter() - start_time
+        sys.stderr.write("\nImport times:\n")
+        for name,t in sorted(self.times.items(),key=lambda x:-x[1]):
+            sys.stderr.write("%10.1f ms  %s\n" % (t*1000,name))
+        sys.stderr.write("%10.1f ms  total imports\n" % (sum(self.times.values())*1000))
+        sys.stderr.write("%10.1f ms  total run time\n" % (total*1000))
+
+
+def print_usage(commands):
+    sys.stderr.write("usage: tbprofiler_cli.py [--import-times] <command> [args]\n\nCommands:\n")
+    for name in sorted(commands):
+        sys.stderr.write("  %s\n" % name)
+
+
+def main(argv):
+    import_timer = None
+    if argv and argv[0]=="--import-times":
+        import_timer = ImportTimer()
+        import_timer.install()
+        argv = argv[1:]
+
+    commands = get_commands()
+    if not argv or argv[0] in ("-h","--help"):
+        print_usage(commands)
+        return
+    if argv[0] not in commands:
+        sys.stderr.write("Unknown command: %s\n\n" % argv[0])
+        print_usage(commands)
+        sys.exit(1)
+
+    import runpy
+    script = commands[argv[0]]
+    # The scripts parse sys.argv themselves
+    sys.argv = [script] + argv[1:]
+    try:
+        runpy.run_path(script,run_name="__main__")
+    finally:
+        if import_timer:
+            import_timer.report()
+
+
+if __name__=="__main__":
+    main(sys.argv[1:])
@@ -5,38 +5,126 @@ import json
 from collections import defaultdict
 import argparse
 import os
-from tqdm import tqdm
 import sys
 import csv
-import pathogenprofiler as pp
-import tbprofiler
-
-
-def get_conf_dict(library_prefix):
-    files = {'gff':'.gff','ref':'.fasta','ann':'.ann.txt','barcode':'.barcode.bed','bed':'.bed','json_db':'.dr.json','version':'.version.json'}
-    conf = {}
-    for key in files:
-        sys.stderr.write('Using %s file: %s\n' % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
+import hashlib
+import functools
+from tbprofiler_utils import get_samples, load_results, add_loader_args, Database, is_archive, read_archive_index
+
+
+def get_row(data,drugs,drug2genes):
+    # The data is organised per variant in data['dr_variants']. We need to 
+    # transform this into a structure which is arranged by drug instead.
+    # We do this by:
+    # 1. Setting up a dictionary (drug_variants) where the values are lists
+    # 2. Loop through all the variants and append the gene/change/freq
+    #    to the list for each drug
+    #
+    # The structure will look like {'isoniazid':['katG_p.Ser315Thr_0.95','fabG1_-15T>C_1.00']}
+    drug_variants = defaultdict(list)
+    for var in data['dr_variants']:
+        for d in var['drugs']:
+            drug_variants[d['drug']].append(f'{var["gene"]}_{var["change"]}_{round(var["freq"],2)}')
+
+    # Create a lookup dictionary containing all the genes for which we have missing coverage
+    # E.g. {'rpoB':'0.2'}
+    gene_coverage = {d['gene']:str(d['fraction']) for d in data['qc']['gene_coverage'] if d['fraction']>0}
+
+    # Set up our row for the final output file with column names being the keys.
+    row = {
+        'main_lineage': data['main_lin'],
+        'sublineage': data['sublin'],
+        'drtype': data['drtype']
+    }
+
+    # For each drug add a column with the variants and another containing a value if there is missin coverage
+    for drug in drugs:
+        row[f'{drug}_variants'] = ", ".join(drug_variants[drug])
+        row[f'{drug}_gene_cov'] = ", ".join([gene_coverage[gene] for gene in drug2genes[drug] if gene in gene_coverage])
+    return row
+
+
+def file_hash(filename):
+    h = hashlib.sha1()
+    with open(filename,'rb') as F:
+        for chunk in iter(lambda: F.read(1<<20),b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_result_stat(result_dir,s,suffix):
+    # Returns (mtime, size) of the result file or None if it is missing. Records
+    # in an archive are never rewritten (a sample which is added again gets a
+    # new record) so their (offset, length) is used instead.
+    if is_archive(result_dir):
+        return read_archive_index(result_dir)[1].get(s)
+    filename = f'{result_dir}/{s}{suffix}'
+    if not os.path.isfile(filename):
+        return None
+    st = os.stat(filename)
+    return st.st_mtime,st.st_size
+
+
+def file_unchanged(entry,result_dir,s,suffix):
+    # Cheap check on mtime and size first and only fall back to hashing the
+    # content if the file has been touched without changing size
+    stat = get_result_stat(result_dir,s,suffix)
+    if stat is None:
+        return False
+    if entry['mtime']==stat[0] and entry['size']==stat[1]:
+        return True
+    if not is_archive(result_dir) and entry['size']==stat[1] and entry['hash']==file_hash(f'{result_dir}/{s}{suffix}'):
+        entry['mtime'] = stat[0]
+        return True
+    return False
+
+
+def load_manifest(filename,key):
+    # The cached rows are only valid for the same database and drug list
+    if not os.path.isfile(filename):
+        return {}
+    manifest = json.load(open(filename))
+    if manifest.get('key')!=key:
+        sys.stderr.write('Database or drug list changed, ignoring manifest %s\n' % filename)
+        return {}
+    return manifest['samples']
+
+
+def write_manifest(filename,key,entries):
+    tmp = filename + '.tmp'
+    with open(tmp,'w') as O:
+        json.dump({'key':key,'samples':entries},O)
+    os.replace(tmp,filename)
+
+
+def get_completed_samples(filename,fieldnames):
+    # Return the samples already written to filename or None if there is no
+    # usable output to resume from. A partially written last line is removed.
+    if not os.path.isfile(filename):
+        return None
+    with open(filename,'rb+') as F:
+        content = F.read()
+        if not content.endswith(b'\n'):
+            F.truncate(content.rfind(b'\n')+1)
+    lines = open(filename).read().splitlines()
+    if len(lines)==0 or lines[0].split("\t")!=fieldnames:
+        return None
+    return set(l.split("\t")[0] for l in lines[1:])
 
 
 def main(args):
-    # Get a dictionary with the database file: {'ref': '/path/to/fasta' ... etc. }
-    conf = get_conf_dict(sys.base_prefix + '/share/tbprofiler/%s' % args.db)
+    # Load the database, db.conf is a dictionary with the database files: {'ref': '/path/to/fasta' ... etc. }
+    db = Database(args.db)
 
     # Get a dictionary mapping the locus_tags to drugs: {'Rv1484': ['isoniazid','ethionamide'], ... etc. }
-    locus_tag2drugs = tbprofiler.get_lt2drugs(conf['bed'])
+    locus_tag2drugs = db.locus_tag2drugs
     
     # Get a dictionary mapping the drug to genes: {'rifampicin': ['rpoB', 'rpoC'], 'clofazimine': ['mmpR5', 'pepQ'], ... etc. }
-    drug2genes = tbprofiler.get_drugs2gene(conf['bed'])
+    drug2genes = db.drug2genes
     
 
     # If a list of samples is supplied through the args object, store it in a list else get the list from looking in the results direcotry
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
-    else:
-        samples = [x.replace(args.suffix,'') for x in os.listdir(args.dir) if x[-len(args.suffix):]==args.suffix]
+    samples = get_samples(args.samples,args.dir,args.suffix)
 
     # Loop through the sample result files
     drugs = [
@@ -44,51 +132,59 @@ def main(args):
         'kanamycin','capreomycin','fluoroquinolones','ethionamide','cycloserine',
         'para-aminosalicylic_acid','clofazimine','bedaquiline','delamanid'
     ]
-
-    # Set up a list which will contain our output file rows
-    rows = []
-
-    for s in tqdm(samples):
-        # Data has the same structure as the .result.json files
-        data = json.load(open(pp.filecheck(f'{args.dir}/{s}{args.suffix}')))
-
-        # The data is organised per variant in data['dr_variants']. We need to 
-        # transform this into a structure which is arranged by drug instead.
-        # We do this by:
-        # 1. Setting up a dictionary (drug_variants) where the values are lists
-        # 2. Loop through all the variants and append the gene/change/freq
-        #    to the list for each drug
-        #
-        # The structure will look like {'isoniazid':['katG_p.Ser315Thr_0.95','fabG1_-15T>C_1.00']}
-        drug_variants = defaultdict(list)
-        for var in data['dr_variants']:
-            for d in var['drugs']:
-                drug_variants[d['drug']].append(f'{var["gene"]}_{var["change"]}_{round(var["freq"],2)}')
-
-        # Create a lookup dictionary containing all the genes for which we have missing coverage
-        # E.g. {'rpoB':'0.2'}
-        gene_coverage = {d['gene']:str(d['fraction']) for d in data['qc']['gene_coverage'] if d['fraction']>0}
-
-        # Set up our row for the final output file with column names being the keys.
-        row = {
-            'sample': s,
-            'main_lineage': data['main_lin'],
-            'sublineage': data['sublin'],
-            'drtype': data['drtype']
-        }
-        
-        # For each drug add a column with the variants and another containing a value if there is missin coverage
-        for drug in drugs:
-            row[f'{drug}_variants'] = ", ".join(drug_variants[drug])
-            row[f'{drug}_gene_cov'] = ", ".join([gene_coverage[gene] for gene in drug2genes[drug] if gene in gene_coverage])
-        rows.append(row)
-
-
-    # Write the output file
-    with open(args.outfile,'w') as O:
-        writer = csv.DictWriter(O,fieldnames=list(rows[0]),delimiter="\t")
-        writer.writeheader()
-        writer.writerows(rows)
+    # Plain dict so that it can be sent to the loader workers
+    drug2genes = {drug:list(drug2genes.get(drug,[])) for drug in drugs}
+
+    # The header is fixed up front so rows can be written as soon as they are produced
+    fieldnames = ['sample','main_lineage','sublineage','drtype']
+    for drug in drugs:
+        fieldnames += [f'{drug}_variants',f'{drug}_gene_cov']
+
+    # When resuming, samples already present in the output file are skipped
+    completed = get_completed_samples(args.outfile,fieldnames) if args.resume else None
+    if completed:
+        sys.stderr.write('Resuming %s after %s completed samples\n' % (args.outfile,len(completed)))
+        samples = [s for s in samples if s not in completed]
+
+    # Rows of samples whose result file has not changed since the last run are
+    # taken from the manifest and only new or modified files are parsed again
+    manifest_key = {'bed':db.conf['bed'],'bed_mtime':os.path.getmtime(db.conf['bed']),'drugs':drugs}
+    cached = load_manifest(args.manifest,manifest_key) if args.manifest else {}
+    entries = {s:cached[s] for s in (completed or []) if s in cached}
+    to_load = []
+    for s in samples:
+        if s in cached and file_unchanged(cached[s],args.dir,s,args.suffix):
+            entries[s] = cached[s]
+        else:
+            to_load.append(s)
+    if args.manifest:
+        sys.stderr.write('Using cached rows for %s samples, loading %s samples\n' % (len(entries),len(to_load)))
+
+    extract = functools.partial(get_row,drugs=drugs,drug2genes=drug2genes)
+    loaded = load_results(to_load,args.dir,args.suffix,extract=extract,workers=args.workers)
+
+    # Write the output file one row at a time
+    with open(args.outfile,'a' if completed is not None else 'w') as O:
+        writer = csv.DictWriter(O,fieldnames=fieldnames,delimiter="\t")
+        if completed is None:
+            writer.writeheader()
+        for i,s in enumerate(samples):
+            if s in entries:
+                row = entries[s]['row']
+            else:
+                # The loader yields in the same order as to_load, which follows samples
+                _,row = next(loaded)
+                if args.manifest:
+                    mtime,size = get_result_stat(args.dir,s,args.suffix)
+                    content_hash = None if is_archive(args.dir) else file_hash(f'{args.dir}/{s}{args.suffix}')
+                    entries[s] = {'mtime':mtime,'size':size,'hash':content_hash,'row':row}
+            writer.writerow({'sample':s,**row})
+            if (i+1)%args.flush_every==0:
+                O.flush()
+
+    # Samples which have been removed are dropped from the manifest
+    if args.manifest:
+        write_manifest(args.manifest,manifest_key,entries)
 
 
 # Set up the parser
@@ -98,6 +194,10 @@ parser.add_argument('--samples',type=str,help='File with samples')
 parser.add_argument('--dir',default='results/',type=str,help='Directory containing results')
 parser.add_argument('--db',default='tbdb',type=str,help='Database name')
 parser.add_argument('--suffix',default='.results.json',type=str,help='File suffix')
+parser.add_argument('--resume',action='store_true',help='Resume writing the output file from the last completed sample')
+parser.add_argument('--flush-every',default=100,type=int,help='Flush the output file after this many rows')
+parser.add_argument('--manifest',type=str,help='Manifest file used to cache rows between runs. Only new or modified result files are parsed again')
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
@@ -5,71 +5,25 @@ import json
 from collections import defaultdict
 import argparse
 import os
-from tqdm import tqdm
 import sys
 import csv
-import pathogenprofiler as pp
-import tbprofiler
-import copy
+from tbprofiler_utils import get_samples, migrate_results, add_migration_args, SCHEMA_VERSIONS
 
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
 
 def main(args):
-    # Get a dictionary with the database file: {"ref": "/path/to/fasta" ... etc. }
-    conf = get_conf_dict(sys.base_prefix + "/share/tbprofiler/%s" % args.db)
-
-    # Get a dictionary mapping the locus_tags to drugs: {"Rv1484": ["isoniazid","ethionamide"], ... etc. }
-    locus_tag2drugs = tbprofiler.get_lt2drugs(conf["bed"])
-
     # If a list of samples is supplied through the args object, store it in a list else get the list from looking in the results direcotry
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
-    else:
-        samples = [x.replace(args.suffix,"") for x in os.listdir(args.in_dir) if x[-len(args.suffix):]==args.suffix]
-
-    if not os.path.isdir(args.out_dir):
-        os.mkdir(args.out_dir)
-    # Loop through the sample result files
-    for s in tqdm(samples):
-        # Data has the same structure as the .result.json files
-        new_dr_variants = defaultdict(list)
-        data = json.load(open(pp.filecheck("%s/%s%s" % (args.in_dir,s,args.suffix))))
-        for var in data["dr_variants"]:
-            tmp = copy.deepcopy(var)
-            del tmp["drug"]
-            x = {"drug":var["drug"]}
-            if "confidence" in tmp:
-                del tmp["confidence"]
-                x["confidence"] = var["confidence"]
-            if "literature" in tmp:
-                del tmp["literature"]
-                x["literature"] = var["literature"]
-
-            new_dr_variants[json.dumps(tmp)].append(x)
+    samples = get_samples(args.samples,args.in_dir,args.suffix)
 
-        data["dr_variants"] = []
-        for x in new_dr_variants:
-            new_var = json.loads(x)
-            new_var["drugs"] = []
-            for d in new_dr_variants[x]:
-                new_var["drugs"].append(d)
-            data["dr_variants"].append(new_var)
-        json.dump(data,open("%s/%s%s" % (args.out_dir,s,args.suffix),"w"))
+    # Files are upgraded from whichever version they are in, so this also works on a mix of versions
+    counts = migrate_results(samples,args.in_dir,args.out_dir,args.suffix,target=args.target,workers=args.workers,overwrite=args.overwrite)
+    for status in sorted(counts):
+        sys.stderr.write("%s: %s\n" % (status,counts[status]))
 
 
 # Set up the parser
-parser = argparse.ArgumentParser(description='tbprofiler script',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument('--samples',type=str,help='File with samples')
-parser.add_argument('--in-dir',default="results/",type=str,help='Directory containing results')
-parser.add_argument('--out-dir',default="results_v3/",type=str,help='Directory containing results')
-parser.add_argument('--db',default="tbdb",type=str,help='Database name')
-parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+parser = argparse.ArgumentParser(description='Convert v2 or v3.0 result files (or a mix) to the current format',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+add_migration_args(parser,default_out_dir="results_v3/")
+parser.add_argument('--target',default=SCHEMA_VERSIONS[-1],choices=SCHEMA_VERSIONS[1:],type=str,help='Schema version to convert to')
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
@@ -4,23 +4,19 @@ import pathogenprofiler as pp
 import argparse
 import json
 import tbprofiler as tbp
+from tbprofiler_utils import get_conf_dict, get_mp_context, StageTimer
 import os
 import csv
+import time
+import copy
 
 try:
     sys.base_prefix
 except:
     sys.base_prefix = getattr(sys, 'base_prefix', getattr(sys, 'real_prefix', sys.prefix))
 
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
-
 def main_profile(args):
+    timer = StageTimer(sample=args.prefix,trace_file=args.trace)
     #### Setup conf dictionary ###
     if args.db=="tbdb" and not args.external_db and pp.nofile(sys.base_prefix+"/share/tbprofiler/tbdb.fasta"):
         pp.log("Can't find the tbdb file at %s. Please run 'tb-profiler update_tbdb' to load the default library or specify another using the '--external_db' flag" % sys.base_prefix,ext=True)
@@ -60,20 +56,23 @@ def main_profile(args):
         elif args.read1 and args.read2 and not args.no_trim:
             # Paired + trimming
             untrimmed_fastq_obj = pp.fastq(args.read1,args.read2)
-            fastq_obj = untrimmed_fastq_obj.trim(files_prefix,threads=args.threads)
+            with timer.stage("trim"):
+                fastq_obj = untrimmed_fastq_obj.trim(files_prefix,threads=args.threads)
         elif args.read1 and not args.read2 and args.no_trim:
             # Unpaired + trimming
             fastq_obj = pp.fastq(args.read1,args.read2)
         elif args.read1 and not args.read2 and not args.no_trim:
             # Unpaired + trimming
             untrimmed_fastq_obj = pp.fastq(args.read1)
-            fastq_obj = untrimmed_fastq_obj.trim(files_prefix,threads=args.threads)
+            with timer.stage("trim"):
+                fastq_obj = untrimmed_fastq_obj.trim(files_prefix,threads=args.threads)
         else:
             exit("\nPlease provide a bam file or a fastq file(s)...Exiting!\n")
-        bam_obj = fastq_obj.map_to_ref(
-            ref_file=conf["ref"], prefix=files_prefix,sample_name=args.prefix,
-            aligner=args.mapper, platform=args.platform, threads=args.threads
-        )
+        with timer.stage("map"):
+            bam_obj = fastq_obj.map_to_ref(
+                ref_file=conf["ref"], prefix=files_prefix,sample_name=args.prefix,
+                aligner=args.mapper, platform=args.platform, threads=args.threads
+            )
         bam_file = bam_obj.bam_file
     else:
         bam_file = args.bam
@@ -81,17 +80,20 @@ def main_profile(args):
     print(args.delly_bcf_file)
     run_coverage = False if args.no_coverage else True
     ### Run profiling module from pathogen-profiler ###
-    results = pp.bam_profiler(
-        conf=conf, bam_file=bam_file, prefix=files_prefix, platform=args.platform,
-        caller=args.caller, threads=args.threads, no_flagstat=args.no_flagstat,
-        run_delly = run_delly, calling_params=args.calling_params,
-        coverage_fraction_threshold=args.coverage_fraction_threshold,
-        missing_cov_threshold=args.missing_cov_threshold,
-        delly_bcf_file=args.delly_bcf_file
-    )
+    # Variant calling and delly are both run inside bam_profiler so they are timed together
+    with timer.stage("call"):
+        results = pp.bam_profiler(
+            conf=conf, bam_file=bam_file, prefix=files_prefix, platform=args.platform,
+            caller=args.caller, threads=args.threads, no_flagstat=args.no_flagstat,
+            run_delly = run_delly, calling_params=args.calling_params,
+            coverage_fraction_threshold=args.coverage_fraction_threshold,
+            missing_cov_threshold=args.missing_cov_threshold,
+            delly_bcf_file=args.delly_bcf_file
+        )
     json.dump(results,open(args.prefix+".tmp_results.json","w"))
     ### Reformat the results to TB-Profiler style ###
-    results = tbp.reformat(results, conf, reporting_af=args.reporting_af)
+    with timer.stage("reformat"):
+        results = tbp.reformat(results, conf, reporting_af=args.reporting_af)
     results["id"] = args.prefix
     results["tbprofiler_version"] = tbp._VERSION
     results["pipeline"] = {"mapper":args.mapper if not args.bam else "N/A","variant_caller":args.caller}
@@ -101,25 +103,25 @@ def main_profile(args):
     text_output = args.dir+"/results/"+args.prefix+".results.txt"
     csv_output = args.dir+"/results/"+args.prefix+".results.csv"
 
-    json.dump(results,open(json_output,"w"))
-    extra_columns = [x.lower() for x in args.add_columns.split(",")] if args.add_columns else []
-    if args.pdf:
-        tbp.write_tex(results,conf,tex_output,extra_columns)
-        pp.run_cmd("pdflatex %s"%tex_output,verbose=1)
-        pp.rm_files([tex_output, args.dir+"/"+args.prefix+".results.aux",args.dir+"/"+args.prefix+".results.log"])
-    if args.txt:
-        tbp.write_text(results,conf,text_output,extra_columns,reporting_af=args.reporting_af)
-    if args.csv:
-        tbp.write_csv(results,conf,csv_output,extra_columns)
-
-    ### Move files to respective directories ###
-    if not args.bam:
-        pp.run_cmd("mv %(dir)s/%(prefix)s.bam* %(dir)s/bam/" % vars(args))
-        if not args.no_trim:
-            pp.run_cmd("rm -f %s" % " ".join(fastq_obj.files))
-    pp.run_cmd("mv -f %(dir)s/%(prefix)s*.vcf.gz* %(dir)s/vcf/" % vars(args))
-    if run_delly and results["delly"]=="success" and not args.delly_bcf_file:
-        pp.run_cmd("mv -f %(dir)s/%(prefix)s.delly.bcf* %(dir)s/vcf/" % vars(args))
+    with timer.stage("output"):
+        extra_columns = [x.lower() for x in args.add_columns.split(",")] if args.add_columns else []
+        if args.pdf:
+            tbp.write_tex(results,conf,tex_output,extra_columns)
+            pp.run_cmd("pdflatex %s"%tex_output,verbose=1)
+            pp.rm_files([tex_output, args.dir+"/"+args.prefix+".results.aux",args.dir+"/"+args.prefix+".results.log"])
+        if args.txt:
+            tbp.write_text(results,conf,text_output,extra_columns,reporting_af=args.reporting_af)
+        if args.csv:
+            tbp.write_csv(results,conf,csv_output,extra_columns)
+
+        ### Move files to respective directories ###
+        if not args.bam:
+            pp.run_cmd("mv %(dir)s/%(prefix)s.bam* %(dir)s/bam/" % vars(args))
+            if not args.no_trim:
+                pp.run_cmd("rm -f %s" % " ".join(fastq_obj.files))
+        pp.run_cmd("mv -f %(dir)s/%(prefix)s.*vcf.gz* %(dir)s/vcf/" % vars(args))
+        if run_delly and results["delly"]=="success" and not args.delly_bcf_file:
+            pp.run_cmd("mv -f %(dir)s/%(prefix)s.delly.bcf* %(dir)s/vcf/" % vars(args))
 
     ### Add meta data to results
     if args.meta:
@@ -127,20 +129,96 @@ def main_profile(args):
             if row["id"]==results["id"]:
                 for col in row:
                     results["meta_"+col] = row[col]
+
+    # The results are written last so that they include the meta data and timings
+    results["pipeline"]["timings"] = timer.timings
+    json.dump(results,open(json_output,"w"))
     pp.log("Profiling finished sucessfully!")
+    return timer.timings
 
 
-if __name__=="__main__":
-    parser = argparse.ArgumentParser(description='TBProfiler pipeline',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('--version', action='version', version="TBProfiler version %s" % tbp._VERSION)
-    subparsers = parser.add_subparsers(help="Task to perform")
+STAGES = ["trim","map","call","reformat","output"]
 
-    parser_sub = subparsers.add_parser('profile', help='Run whole profiling pipeline', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+def read_sample_sheet(filename):
+    # CSV with an "id" column and read1/read2 or bam columns
+    samples = []
+    for row in csv.DictReader(open(filename)):
+        samples.append({
+            "prefix": row["id"],
+            "read1": row.get("read1") or None,
+            "read2": row.get("read2") or None,
+            "bam": row.get("bam") or None,
+        })
+    return samples
+
+
+def valid_result(filename,sample_id):
+    try:
+        return json.load(open(filename)).get("id")==sample_id
+    except (OSError,ValueError,AttributeError):
+        return False
+
+
+def run_batch_sample(args):
+    start = time.perf_counter()
+    try:
+        timings = main_profile(args)
+        status = "done"
+    except (Exception,SystemExit) as e:
+        # pp.log exits on errors so SystemExit is also caught. KeyboardInterrupt
+        # is not, so Ctrl-C stops the whole run.
+        pp.log("Profiling failed for %s: %s" % (args.prefix,repr(e)))
+        timings = {}
+        status = "failed"
+    return args.prefix,status,timings,time.perf_counter() - start
+
+
+def main_batch(args):
+    import concurrent.futures
+    samples = read_sample_sheet(args.sample_sheet)
+
+    # Create the folders before starting the workers to avoid races
+    for x in ["","bam","vcf","results"]:
+        os.makedirs(os.path.join(args.dir,x),exist_ok=True)
+
+    cpus = args.cpus if args.cpus else os.cpu_count()
+    args.threads = min(args.threads,cpus)
+    num_workers = max(1,cpus // args.threads)
+    pp.log("Running %s samples at a time with %s threads each" % (num_workers,args.threads))
+
+    timings_file = open(args.timings,"w")
+    writer = csv.writer(timings_file,delimiter="\t")
+    writer.writerow(["sample","status"] + STAGES + ["total"])
+
+    jobs = []
+    for sample in samples:
+        if not args.overwrite and valid_result("%s/results/%s.results.json" % (args.dir,sample["prefix"]),sample["prefix"]):
+            writer.writerow([sample["prefix"],"skipped"] + ["NA" for _ in STAGES] + ["NA"])
+            continue
+        sample_args = copy.copy(args)
+        vars(sample_args).update(sample)
+        del sample_args.func
+        jobs.append(sample_args)
+    pp.log("Skipping %s samples with existing results" % (len(samples)-len(jobs)))
+
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(num_workers,mp_context=get_mp_context()) as executor:
+        futures = [executor.submit(run_batch_sample,job) for job in jobs]
+        for i,future in enumerate(concurrent.futures.as_completed(futures)):
+            prefix,status,timings,total = future.result()
+            if status=="failed":
+                failed += 1
+            writer.writerow([prefix,status] + ["%.2f" % timings[x]["wall"] if x in timings else "NA" for x in STAGES] + ["%.2f" % total])
+            timings_file.flush()
+            pp.log("Finished %s (%s/%s)" % (prefix,i+1,len(jobs)))
+    timings_file.close()
+    pp.log("Batch finished: %s profiled, %s failed, %s skipped" % (len(jobs)-failed,failed,len(samples)-len(jobs)))
+
+
+def add_profile_args(parser_sub):
+    # Arguments shared by the profile and batch subcommands
     parser_sub.add_argument('--platform','-m',choices=["illumina","nanopore"],default="illumina",help='NGS Platform used to generate data')
-    parser_sub.add_argument('--read1','-1',help='First read file')
-    parser_sub.add_argument('--read2','-2',help='Second read file')
-    parser_sub.add_argument('--bam','-a',help='BAM file. Make sure it has been generated using the H37Rv genome (GCA_000195955.2)')
-    parser_sub.add_argument('--prefix','-p',default="tbprofiler",help='Sample prefix for all results generated')
     parser_sub.add_argument('--no_trim',action="store_true",help="Don't trim files using trimmomatic")
     parser_sub.add_argument('--db',default='tbdb',help='Mutation panel name')
     parser_sub.add_argument('--external_db',type=str,help='Path to db files prefix (overrides "--db" parameter)')
@@ -162,12 +240,34 @@ if __name__=="__main__":
     parser_sub.add_argument('--no_delly',action="store_true",help="Don't collect flagstats")
     parser_sub.add_argument('--delly_bcf_file',help="Precomputed delly bcf file")
     parser_sub.add_argument('--no_coverage',action="store_true",help="Don't collect coverage stats")
-    parser_sub.add_argument('--version', action='version', version="TBProfiler version %s" % tbp._VERSION)
     parser_sub.add_argument('--dump_tmp_results',action="store_true",help="Dump temp results")
     parser_sub.add_argument('--coverage_fraction_threshold',default=0,type=int,help='Cutoff used to calculate fraction of region covered by <= this value')
     parser_sub.add_argument('--missing_cov_threshold',default=10,type=int,help='Cutoff used to positions/codons in genes which are missing')
+    parser_sub.add_argument('--trace',type=str,help='Append the timing and resource usage of each stage to this JSON-lines file')
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='TBProfiler pipeline',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--version', action='version', version="TBProfiler version %s" % tbp._VERSION)
+    subparsers = parser.add_subparsers(help="Task to perform")
+
+    parser_sub = subparsers.add_parser('profile', help='Run whole profiling pipeline', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_sub.add_argument('--read1','-1',help='First read file')
+    parser_sub.add_argument('--read2','-2',help='Second read file')
+    parser_sub.add_argument('--bam','-a',help='BAM file. Make sure it has been generated using the H37Rv genome (GCA_000195955.2)')
+    parser_sub.add_argument('--prefix','-p',default="tbprofiler",help='Sample prefix for all results generated')
+    parser_sub.add_argument('--version', action='version', version="TBProfiler version %s" % tbp._VERSION)
+    add_profile_args(parser_sub)
     parser_sub.set_defaults(func=main_profile)
 
+    parser_sub = subparsers.add_parser('batch', help='Run the profiling pipeline on many samples in parallel', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_sub.add_argument('--sample_sheet',required=True,help='CSV file with an "id" column and "read1"/"read2" or "bam" columns')
+    parser_sub.add_argument('--cpus',type=int,help='Total number of CPUs to use. Samples are run in parallel using --threads each (default: all CPUs)')
+    parser_sub.add_argument('--timings',default="batch_timings.tsv",type=str,help='Output file with the status and per-stage timings of each sample')
+    parser_sub.add_argument('--overwrite',action="store_true",help="Rerun samples which already have a valid result file")
+    add_profile_args(parser_sub)
+    parser_sub.set_defaults(func=main_batch)
+
 
     args = parser.parse_args()
     if vars(args)=={}:
@@ -3,79 +3,80 @@ import json
 from collections import defaultdict
 import argparse
 import os
-from tqdm import tqdm
 import sys
 import csv
-import pathogenprofiler as pp
-import statsmodels.api as sm
+from tbprofiler_utils import get_samples, load_results, add_loader_args, Database, test_2x2_tables
+import functools
 import numpy as np
+from scipy import sparse
 
 
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
+def get_mutations(data,gene_set,synonymous):
+    mutations = set()
+    for var in (data["dr_variants"] + data["other_variants"]):
+        if gene_set and (var["gene"] not in gene_set and var["locus_tag"] not in gene_set):
+            continue
+        if not synonymous and var["type"]=="synonymous":
+            continue
+        mutations.add(var["gene"]+"_"+var["change"])
+    # Sorted so the mutation order (and the output) does not depend on the hash seed
+    return sorted(mutations)
 
 
 def main(args):
-    conf = get_conf_dict(sys.base_prefix + "/share/tbprofiler/%s" % args.db)
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
-    else:
-        samples = [x.replace(args.suffix,"") for x in os.listdir(args.dir) if x[-len(args.suffix):]==args.suffix]
+    db = Database(args.db)
+    samples = get_samples(args.samples,args.dir,args.suffix)
 
-    mutations = defaultdict(lambda: defaultdict(int))
+    # Build a sparse sample x mutation presence/absence matrix
     gene_set = set(args.genes.split(",")) if args.genes else None
-    for s in tqdm(samples):
-        data = json.load(open(pp.filecheck("%s/%s%s" % (args.dir,s,args.suffix))))
-        for var1 in (data["dr_variants"] + data["other_variants"]):
-            if args.genes and (var1["gene"] not in gene_set and var1["locus_tag"] not in gene_set):
-                continue
-            if not args.synonymous and var1["type"]=="synonymous":
-                continue
-            for var2 in (data["dr_variants"] + data["other_variants"]):
-                if args.genes and (var2["gene"] not in gene_set and var2["locus_tag"] not in gene_set):
-                    continue
-                if not args.synonymous and var2["type"]=="synonymous":
-                    continue
-                mutations[var1["gene"]+"_"+var1["change"]][var2["gene"]+"_"+var2["change"]] += 1
-
-    for mut1 in tqdm(mutations):
-        for mut2 in mutations[mut1]:
-            total_mut1 = mutations[mut1][mut1]
-            total_mut2 = mutations[mut2][mut2]
-
-
-            t = [
-                [0,0],
-                [0,0]
-            ]
-            t[0][0] = mutations[mut1][mut2]
-            t[1][0] = total_mut1 - t[0][0]
-            t[0][1] = total_mut2 - t[0][0]
-            t[1][1] = len(samples) - t[0][1] - t[1][0] - t[0][0]
-            t2 = sm.stats.Table2x2(np.asarray(t))
-            OR = t2.oddsratio if t[0]!=[0.5,0.5] else "NA"
-            OR_pval = t2.oddsratio_pvalue() if t[0]!=[0.5,0.5] else "NA"
-            pval = t2.test_nominal_association().pvalue
-            print("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (mut1,mut2,total_mut1,total_mut2,mutations[mut1][mut2],OR,OR_pval,pval),t)
-
-
-
+    extract = functools.partial(get_mutations,gene_set=gene_set,synonymous=args.synonymous)
+    mutation_index = {}
+    rows = []
+    cols = []
+    for i,(s,mutations) in enumerate(load_results(samples,args.dir,args.suffix,extract=extract,workers=args.workers)):
+        for mut in mutations:
+            rows.append(i)
+            cols.append(mutation_index.setdefault(mut,len(mutation_index)))
+    mutation_names = list(mutation_index)
+    X = sparse.csr_matrix((np.ones(len(rows),dtype=np.int32),(rows,cols)),shape=(len(samples),len(mutation_names)))
+
+    # All pairwise co-occurrence counts come from a single sparse product.
+    # Only pairs seen together at least --min-count times are tested.
+    totals = np.asarray(X.sum(axis=0)).ravel()
+    counts = (X.T @ X).tocsr()
+    if args.min_count>0:
+        cooccurrence = sparse.triu(counts,k=1).tocoo()
+        keep = cooccurrence.data>=args.min_count
+        idx1,idx2,both = cooccurrence.row[keep],cooccurrence.col[keep],cooccurrence.data[keep]
+    else:
+        # Pairs never seen together are tested as well, their counts are read
+        # from the sparse matrix without making it dense
+        idx1,idx2 = np.triu_indices(len(mutation_names),k=1)
+        both = np.asarray(counts[idx1,idx2]).ravel()
+    sys.stderr.write("Testing %s mutation pairs\n" % len(both))
 
+    odds_ratio,or_pval,pval = test_2x2_tables(both,totals[idx1],totals[idx2],len(samples))
 
+    with open(args.out,"w") as O:
+        writer = csv.writer(O,delimiter="\t")
+        writer.writerow(["mutation1","mutation2","total_mutation1","total_mutation2","both","odds_ratio","odds_ratio_pval","pval"])
+        for i in range(len(both)):
+            writer.writerow([
+                mutation_names[idx1[i]],mutation_names[idx2[i]],totals[idx1[i]],totals[idx2[i]],both[i],
+                odds_ratio[i],or_pval[i],"NA" if np.isnan(pval[i]) else pval[i]
+            ])
 
 
 parser = argparse.ArgumentParser(description='tbprofiler script',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--out',type=str,help='Output TSV file',required=True)
 parser.add_argument('--samples',type=str,help='File with samples')
 parser.add_argument('--genes',type=str,help='Genes to include')
 parser.add_argument('--synonymous',action="store_true",help='File with samples')
+parser.add_argument('--min-count',default=1,type=int,help='Only test pairs of mutations found together in at least this many samples (0 tests all pairs)')
 parser.add_argument('--dir',default="results/",type=str,help='Directory containing results')
 parser.add_argument('--db',default="tbdb",type=str,help='Database name')
 parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
@@ -3,64 +3,201 @@ import json
 from collections import defaultdict
 import argparse
 import os
-from tqdm import tqdm
 import sys
 import csv
-import pathogenprofiler as pp
+from tbprofiler_utils import get_samples, load_results, add_loader_args, read_variant_store
 import re
-from itertools import chain
-
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
+import numpy as np
+from scipy import sparse
 
 true_variants = {
     "por1": [("gyrA","p.Asp94Ala"),("rpoB","p.Ser450Leu"),("rrs","r.1401a>g"),("fabG1","c.-15C>T"),("inhA","p.Ile194Thr"),("pncA","p.Val125Gly"),("embA","c.-16C>T"),("embB","p.Met306Val"),("embB","p.Met423Thr"),("gid","p.Ala80Pro")],
 
 }
 
+def load_truth(filename):
+    # TSV with sample, gene and change columns, one true variant per line. An
+    # optional type column gives the type of variants which are never called.
+    truth = defaultdict(list)
+    truth_types = {}
+    for row in csv.DictReader(open(filename),delimiter="\t"):
+        truth[row["sample"]].append((row["gene"],row["change"]))
+        if row.get("type"):
+            truth_types[(row["gene"],row["change"])] = row["type"]
+    return truth,truth_types
+
+def infer_variant_type(change):
+    # Type of a true variant from its HGVS change, for variants not called in any run
+    if change.startswith("p."):
+        if "fs" in change: return "frameshift"
+        if change.endswith("*") or change.endswith("Ter"): return "stop_gained"
+        if "del" in change: return "inframe_deletion"
+        if "ins" in change or "dup" in change: return "inframe_insertion"
+        if change.endswith("="): return "synonymous"
+        return "missense"
+    if change.startswith("c.-"): return "upstream"
+    if change.startswith("r.") or change.startswith("n."): return "non_coding"
+    return "unknown"
+
+def get_biological_sample(run):
+    biological_sample_name = ""
+    re_obj = re.search("H37Rv[\d]_mq[\d]+_bq[\d]+",run)
+    if re_obj:
+        biological_sample_name = "H37Rv"
+    re_obj = re.search("(por[\d]+).*_mq[\d]+_bq[\d]+",run)
+    if re_obj:
+        biological_sample_name = re_obj.group(1)
+    return biological_sample_name
+
+def get_param_set(run):
+    re_obj = re.search("(mq[\d]+_bq[\d]+)",run)
+    return re_obj.group(1) if re_obj else run
+
+def keep_variant(var_type,dr_variant,args):
+    if not dr_variant and not args.other_variants:
+        return False
+    return args.types=="all" or var_type in args.types
+
+def get_calls(data):
+    # Returns {(gene, change): (type, dr_variant)} for all variants
+    calls = {}
+    for dr_variant,pool in [(True,data["dr_variants"]),(False,data["other_variants"])]:
+        for var in pool:
+            calls[(var["gene"],var["change"])] = (var["type"],dr_variant)
+    return calls
+
+def score_runs(runs,run_calls,run_truth):
+    """
+    Count the true positives, false positives and false negatives of all
+    runs at once from sparse run x variant matrices of the calls and of the
+    true variants.
+    """
+    variant_index = {}
+    def get_matrix(sets):
+        rows,cols = [],[]
+        for i,run in enumerate(runs):
+            for var in sets[run]:
+                rows.append(i)
+                cols.append(variant_index.setdefault(var,len(variant_index)))
+        return rows,cols
+    call_rows,call_cols = get_matrix(run_calls)
+    truth_rows,truth_cols = get_matrix(run_truth)
+    shape = (len(runs),len(variant_index))
+    calls = sparse.csr_matrix((np.ones(len(call_rows)),(call_rows,call_cols)),shape=shape)
+    truth = sparse.csr_matrix((np.ones(len(truth_rows)),(truth_rows,truth_cols)),shape=shape)
+    tp = np.asarray(calls.multiply(truth).sum(axis=1)).ravel()
+    fp = np.asarray(calls.sum(axis=1)).ravel() - tp
+    fn = np.asarray(truth.sum(axis=1)).ravel() - tp
+    return tp.astype(int),fp.astype(int),fn.astype(int)
+
+def get_metrics(tp,fp,fn):
+    precision = tp/(tp+fp) if tp+fp>0 else "NA"
+    recall = tp/(tp+fn) if tp+fn>0 else "NA"
+    f1 = 2*tp/(2*tp+fp+fn) if tp+fp+fn>0 else "NA"
+    return precision,recall,f1
+
 def main(args):
-    conf = get_conf_dict(sys.base_prefix + "/share/tbprofiler/%s" % args.db)
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
+    args.types = args.types if args.types=="all" else args.types.split(",")
+    truth,truth_types = load_truth(args.truth) if args.truth else (true_variants,{})
+
+    run2sample = {}
+    run2name = {}
+    run2dir = {}
+    if args.sweep_index:
+        # Runs written by "tbprofiler_test_calling_params.py sweep". Older
+        # indexes have no results_dir column and use --dir.
+        for row in csv.DictReader(open(args.sweep_index),delimiter="\t"):
+            if row["status"]=="done":
+                run2sample[row["run"]] = row["sample"]
+                run2name[row["run"]] = row["name"]
+                run2dir[row["run"]] = row.get("results_dir") or args.dir
+        samples = list(run2sample)
+    else:
+        samples = get_samples(args.samples,args.dir,args.suffix) if args.samples or not args.store else None
+
+    # All variants of each run with their type and whether they are in the resistance database
+    run_variants = {}
+    if args.store:
+        # Read the variants from the store built with tbprofiler_index.py instead of the json files
+        columns = ["sample_id","gene","change","type","dr_variant"]
+        store_samples,table = read_variant_store(args.store,columns=columns)
+        samples = samples if samples else store_samples
+        run_variants = {s:{} for s in samples}
+        for s,gene,change,var_type,dr_variant in zip(*[table.column(c).to_pylist() for c in columns]):
+            if s in run_variants:
+                run_variants[s][(gene,change)] = (var_type,dr_variant)
     else:
-        samples = [x.replace(args.suffix,"") for x in os.listdir(args.dir) if x[-len(args.suffix):]==args.suffix]
-    sample_mutations = defaultdict(lambda:defaultdict(set))
-    for s in tqdm(samples):
-        biological_sample_name = ""
-        re_obj = re.search("H37Rv[\d]_mq[\d]+_bq[\d]+",s)
-        if re_obj:
-            biological_sample_name = "H37Rv"
-        re_obj = re.search("(por[\d]+).*_mq[\d]+_bq[\d]+",s)
-        if re_obj:
-            biological_sample_name = re_obj.group(1)
+        dir2runs = defaultdict(list)
+        for s in samples:
+            dir2runs[run2dir.get(s,args.dir)].append(s)
+        for result_dir,dir_samples in dir2runs.items():
+            for s,calls in load_results(dir_samples,result_dir,args.suffix,extract=get_calls,workers=args.workers):
+                run_variants[s] = calls
 
+    # The true variants are filtered in the same way as the calls, otherwise
+    # true variants of other types could never be matched and would always be
+    # counted as false negatives. Variants not called in any run take their
+    # type from the truth file or the change and are assumed to be in the
+    # resistance database.
+    variant_info = {}
+    for calls in run_variants.values():
+        variant_info.update(calls)
+    def keep_true_variant(var):
+        var_type,dr_variant = variant_info.get(var,(truth_types.get(var) or infer_variant_type(var[1]),True))
+        return keep_variant(var_type,dr_variant,args)
+    run_calls = {s:{var for var,(var_type,dr_variant) in calls.items() if keep_variant(var_type,dr_variant,args)} for s,calls in run_variants.items()}
 
-        data = json.load(open(pp.filecheck("%s/%s%s" % (args.dir,s,args.suffix))))
-        for var in data["dr_variants"]:
-            if var["type"]=="missense":
-                sample_mutations[biological_sample_name][s].add((var["gene"],var["change"]))
+    runs = []
+    run_truth = {}
+    for s in samples:
+        biological_sample_name = run2sample.get(s) or get_biological_sample(s)
+        if biological_sample_name not in truth:
+            sys.stderr.write("No true variants for %s, skipping\n" % s)
+            continue
+        runs.append(s)
+        run_truth[s] = {var for var in truth[biological_sample_name] if keep_true_variant(var)}
+        run2sample[s] = biological_sample_name
+        run2name.setdefault(s,get_param_set(s))
 
+    tp,fp,fn = score_runs(runs,run_calls,run_truth)
 
-    for s in sample_mutations:
-        union_mutations = set(list(chain(*[sample_mutations[s][run] for run in sample_mutations[s]])))
-        for run in sample_mutations[s]:
-            diff = union_mutations - set(sample_mutations[s][run])
-            print("%s\t%s\t%s\t%s" % (s,run,len(union_mutations),len(sample_mutations[s][run])))
+    with open(args.out,"w") as O:
+        writer = csv.writer(O,delimiter="\t")
+        writer.writerow(["run","sample","name","tp","fp","fn","precision","recall","f1"])
+        for i,run in enumerate(runs):
+            writer.writerow([run,run2sample[run],run2name[run],tp[i],fp[i],fn[i]] + list(get_metrics(tp[i],fp[i],fn[i])))
 
+    # Leaderboard of the parameter sets using the counts summed over the samples
+    name_counts = defaultdict(lambda: np.zeros(4,dtype=int))
+    for i,run in enumerate(runs):
+        name_counts[run2name[run]] += [1,tp[i],fp[i],fn[i]]
+    leaderboard = []
+    for name,(num_runs,name_tp,name_fp,name_fn) in name_counts.items():
+        precision,recall,f1 = get_metrics(name_tp,name_fp,name_fn)
+        leaderboard.append([name,num_runs,name_tp,name_fp,name_fn,precision,recall,f1])
+    leaderboard.sort(key=lambda x: [-(v if v!="NA" else -1) for v in (x[7],x[6],x[5])])
+    with open(args.leaderboard,"w") as O:
+        writer = csv.writer(O,delimiter="\t")
+        writer.writerow(["rank","name","runs","tp","fp","fn","precision","recall","f1"])
+        for i,row in enumerate(leaderboard):
+            writer.writerow([i+1] + row)
 
 
 
 
 parser = argparse.ArgumentParser(description='tbprofiler script',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('--samples',type=str,help='File with samples')
-parser.add_argument('--dir',default="results/",type=str,help='Directory containing results')
-parser.add_argument('--db',default="tbdb",type=str,help='Database name')
+parser.add_argument('--dir',default="results/",type=str,help='Directory containing results (with --sweep_index only used for indexes without a results_dir column)')
+parser.add_argument('--db',default="tbdb",type=str,help='Not used, accepted so that existing command lines still work')
 parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+parser.add_argument('--sweep_index',type=str,help='Sweep index written by tbprofiler_test_calling_params.py sweep (used instead of --dir and --samples)')
+parser.add_argument('--store',type=str,help='Variant store created with tbprofiler_index.py (used instead of the result files)')
+parser.add_argument('--truth',type=str,help='TSV file with sample, gene, change and optionally type columns listing the true variants of each sample (default: the true_variants in this script)')
+parser.add_argument('--types',default="missense",type=str,help='Comma separated variant types to score or "all"')
+parser.add_argument('--other_variants',action="store_true",help='Also score variants which are not in the resistance database')
+parser.add_argument('--out',default="calling_params_scores.tsv",type=str,help='Output file with the scores of each run')
+parser.add_argument('--leaderboard',default="calling_params_leaderboard.tsv",type=str,help='Output file with the parameter sets ranked by F1, recall and precision')
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
@@ -3,42 +3,20 @@ import json
 from collections import defaultdict
 import argparse
 import os
-from tqdm import tqdm
 import sys
 import csv
-import pathogenprofiler as pp
+from tbprofiler_utils import get_samples, load_results, add_loader_args, Database
 from itertools import chain
 
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
-
-
 def main(args):
-    conf = get_conf_dict(sys.base_prefix + "/share/tbprofiler/%s" % args.db)
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
-    else:
-        samples = [x.replace(args.suffix,"") for x in os.listdir(args.dir) if x[-len(args.suffix):]==args.suffix]
+    db = Database(args.db)
+    samples = get_samples(args.samples,args.dir,args.suffix)
 
-    drugs = set()
-    rv2drugs = {}
-    drugs2rv = {}
-    for line in open(conf["bed"]):
-        row = line.strip().split()
-        rv2drugs[row[3]] = row[5].split(",")
-        for drug in row[5].split(","):
-            drugs.add(drug)
-            drugs2rv[drug] = row[3]
-    drugs = sorted(list(drugs))
+    rv2drugs = db.locus_tag2drugs
+    drugs = db.drugs
 
     sys.stdout.write("sample,lineage,sublineage,drtype,%s\n" % (",".join(["dr_mutations_%s,other_mutations_%s" % (d,d) for d in drugs])))
-    for s in tqdm(samples):
-        data = json.load(open(pp.filecheck("%s/%s%s" % (args.dir,s,args.suffix))))
+    for s,data in load_results(samples,args.dir,args.suffix,workers=args.workers):
         mutations = defaultdict(set)
         for var in data["dr_variants"]+data["other_variants"]:
             if var["type"]=="synonymous": continue
@@ -65,6 +43,7 @@ parser.add_argument('--dir',default="results/",type=str,help='Directory containi
 parser.add_argument('--db',default="tbdb",type=str,help='Database name')
 parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
 
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
@@ -1,6 +1,7 @@
 import json
 import argparse
 import os
+from tbprofiler_utils import get_samples, load_results, add_loader_args
 
 def main(args):
     if args.itol:
@@ -12,12 +13,12 @@ COLOR\t#ff0000
 
 DATA
 """)
-    samples = [x.replace(args.suffix,"") for x in os.listdir(args.dir) if x[-len(args.suffix):]==args.suffix]
-    for s in samples:
-        j = json.load(open("%s/%s%s" % (args.dir,s,args.suffix)))
+    samples = get_samples(args.samples,args.dir,args.suffix)
+    # Files of any schema version are presented with dr_variants/other_variants and locus_tag
+    for s,j in load_results(samples,args.dir,args.suffix,fields=["dr_variants","other_variants"],workers=args.workers):
         mutation_not_found = True
-        for var in j["variants"]:
-            if var["gene_id"]==args.gene and var["change"]==args.mutation:
+        for var in j["dr_variants"]+j["other_variants"]:
+            if (var["locus_tag"]==args.gene or var["gene"]==args.gene) and var["change"]==args.mutation:
                 print("%s\t%s" % (s,var["freq"]))
                 if args.itol:
                     I.write("%s\t%s\n" % (s,var["freq"]))
@@ -36,7 +37,9 @@ parser.add_argument('gene')
 parser.add_argument('mutation')
 parser.add_argument('--dir',type=str,default="results",help='Result directory')
 parser.add_argument('--suffix',type=str,default=".results.json",help='Output file suffix')
+parser.add_argument('--samples',type=str,help='File with samples')
 parser.add_argument('--itol',action="store_true")
+add_loader_args(parser)
 parser.set_defaults(func=main)
 args = parser.parse_args()
 args.func(args)
@@ -3,30 +3,16 @@ import json
 from collections import defaultdict
 import argparse
 import os
-from tqdm import tqdm
 import sys
 import csv
-import pathogenprofiler as pp
-
-
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
+from tbprofiler_utils import get_samples, load_results, add_loader_args, Database
 
 
 def main(args):
-    conf = get_conf_dict(sys.base_prefix + "/share/tbprofiler/%s" % args.db)
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
-    else:
-        samples = [x.replace(args.suffix,"") for x in os.listdir(args.dir) if x[-len(args.suffix):]==args.suffix]
+    db = Database(args.db)
+    samples = get_samples(args.samples,args.dir,args.suffix)
 
-    for s in tqdm(samples):
-        data = json.load(open(pp.filecheck("%s/%s%s" % (args.dir,s,args.suffix))))
+    for s,data in load_results(samples,args.dir,args.suffix,fields=["lineage"],workers=args.workers):
         for lin in data["lineage"]:
             if lin["lin"]==args.lineage and lin["frac"]<0.95:
                 print(s)
@@ -37,6 +23,7 @@ parser.add_argument('--samples',type=str,help='File with samples')
 parser.add_argument('--dir',default="results/",type=str,help='Directory containing results')
 parser.add_argument('--db',default="tbdb",type=str,help='Database name')
 parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
@@ -5,38 +5,24 @@ import json
 from collections import defaultdict
 import argparse
 import os
-from tqdm import tqdm
 import sys
 import csv
-import pathogenprofiler as pp
-import tbprofiler
+from tbprofiler_utils import get_samples, load_results, add_loader_args, Database
 
 
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
-
 def main(args):
-    # Get a dictionary with the database file: {"ref": "/path/to/fasta" ... etc. }
-    conf = get_conf_dict(sys.base_prefix + "/share/tbprofiler/%s" % args.db)
+    # Load the database, db.conf is a dictionary with the database files: {"ref": "/path/to/fasta" ... etc. }
+    db = Database(args.db)
 
     # Get a dictionary mapping the locus_tags to drugs: {"Rv1484": ["isoniazid","ethionamide"], ... etc. }
-    locus_tag2drugs = tbprofiler.get_lt2drugs(conf["bed"])
+    locus_tag2drugs = db.locus_tag2drugs
 
     # If a list of samples is supplied through the args object, store it in a list else get the list from looking in the results direcotry
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
-    else:
-        samples = [x.replace(args.suffix,"") for x in os.listdir(args.dir) if x[-len(args.suffix):]==args.suffix]
+    samples = get_samples(args.samples,args.dir,args.suffix)
 
     # Loop through the sample result files
-    for s in tqdm(samples):
+    for s,data in load_results(samples,args.dir,args.suffix,workers=args.workers):
         # Data has the same structure as the .result.json files
-        data = json.load(open(pp.filecheck("%s/%s%s" % (args.dir,s,args.suffix))))
         for var in data["dr_variants"]+data["other_variants"]:
             if var["gene"]==args.gene or var["locus_tag"]==args.gene:
                 if args.type in var["type"]:
@@ -51,6 +37,7 @@ parser.add_argument('--samples',type=str,help='File with samples')
 parser.add_argument('--dir',default="results/",type=str,help='Directory containing results')
 parser.add_argument('--db',default="tbdb",type=str,help='Database name')
 parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
@@ -5,47 +5,107 @@ import json
 from collections import defaultdict
 import argparse
 import os
-from tqdm import tqdm
 import sys
 import csv
-import pathogenprofiler as pp
-import tbprofiler
+from tbprofiler_utils import get_samples, load_results, add_loader_args, read_variant_store, Database
 
 
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
+def get_variant_keys(data):
+    return [(var["gene"],var["change"]) for var in data["dr_variants"] + data["other_variants"]]
 
 def main(args):
-    # Get a dictionary with the database file: {"ref": "/path/to/fasta" ... etc. }
-    conf = get_conf_dict(sys.base_prefix + "/share/tbprofiler/%s" % args.db)
+    # Load the database, db.conf is a dictionary with the database files: {"ref": "/path/to/fasta" ... etc. }
+    db = Database(args.db)
 
     # Get a dictionary mapping the locus_tags to drugs: {"Rv1484": ["isoniazid","ethionamide"], ... etc. }
-    locus_tag2drugs = tbprofiler.get_lt2drugs(conf["bed"])
+    locus_tag2drugs = db.locus_tag2drugs
 
-    # If a list of samples is supplied through the args object, store it in a list else get the list from looking in the results direcotry
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
+    # Rows of the matrix are the variants and the columns are the samples.
+    # For each variant only the column indexes of the samples carrying it are stored.
+    variants = defaultdict(set)
+    if args.store:
+        # Read the variants from the store built with tbprofiler_index.py instead of the json files
+        store_samples,table = read_variant_store(args.store,columns=["sample_id","gene","change"])
+        samples = get_samples(args.samples,args.dir,args.suffix) if args.samples else store_samples
+        sample_index = {s:i for i,s in enumerate(samples)}
+        for s,gene,change in zip(*[table.column(c).to_pylist() for c in ["sample_id","gene","change"]]):
+            if s in sample_index:
+                variants[(gene,change)].add(sample_index[s])
     else:
-        samples = [x.replace(args.suffix,"") for x in os.listdir(args.dir) if x[-len(args.suffix):]==args.suffix]
+        # If a list of samples is supplied through the args object, store it in a list else get the list from looking in the results direcotry
+        samples = get_samples(args.samples,args.dir,args.suffix)
+        sample_index = {s:i for i,s in enumerate(samples)}
 
-    variants = defaultdict(list)
-    # Loop through the sample result files
-    for s in tqdm(samples):
-        # Data has the same structure as the .result.json files
-        data = json.load(open(pp.filecheck("%s/%s%s" % (args.dir,s,args.suffix))))
-        for var in data["dr_variants"] + data["other_variants"]:
-            variants[(var["gene"],var["change"])].append(s)
+        # Loop through the sample result files
+        for s,keys in load_results(samples,args.dir,args.suffix,extract=get_variant_keys,workers=args.workers):
+            for key in keys:
+                variants[key].add(sample_index[s])
 
-    with open(args.out,"w") as O:
+    # CSR structure of the matrix
+    keys = list(variants)
+    indptr = [0]
+    indices = []
+    for key in keys:
+        indices.extend(sorted(variants[key]))
+        indptr.append(len(indices))
+
+    if args.format=="csv":
+        write_dense_csv(args.out,keys,samples,indptr,indices)
+    elif args.format=="long":
+        write_long_tsv(args.out,keys,samples,indptr,indices)
+    else:
+        if args.format=="mtx":
+            write_matrix_market(args.out,keys,samples,indptr,indices)
+        else:
+            write_npz(args.out,keys,samples,indptr,indices)
+        write_labels(args.out,keys,samples)
+
+
+def write_dense_csv(filename,keys,samples,indptr,indices):
+    with open(filename,"w") as O:
         O.write("Gene,Variant,%s\n" % ",".join(samples))
-        for key in variants:
-            samps = variants[key]
-            O.write("%s,%s,%s\n" % (key[0],key[1],",".join(["1" if s in samps else "0" for s in samples])))
+        for i,key in enumerate(keys):
+            row = ["0"] * len(samples)
+            for j in indices[indptr[i]:indptr[i+1]]:
+                row[j] = "1"
+            O.write("%s,%s,%s\n" % (key[0],key[1],",".join(row)))
+
+
+def write_long_tsv(filename,keys,samples,indptr,indices):
+    with open(filename,"w") as O:
+        O.write("gene\tvariant\tsample\n")
+        for i,key in enumerate(keys):
+            for j in indices[indptr[i]:indptr[i+1]]:
+                O.write("%s\t%s\t%s\n" % (key[0],key[1],samples[j]))
+
+
+def write_matrix_market(filename,keys,samples,indptr,indices):
+    with open(filename,"w") as O:
+        O.write("%%MatrixMarket matrix coordinate integer general\n")
+        O.write("%s %s %s\n" % (len(keys),len(samples),len(indices)))
+        for i in range(len(keys)):
+            for j in indices[indptr[i]:indptr[i+1]]:
+                O.write("%s %s 1\n" % (i+1,j+1))
+
+
+def write_npz(filename,keys,samples,indptr,indices):
+    import numpy as np
+    from scipy import sparse
+    matrix = sparse.csr_matrix(
+        (np.ones(len(indices),dtype=np.int8),np.asarray(indices,dtype=np.int32),np.asarray(indptr,dtype=np.int64)),
+        shape=(len(keys),len(samples))
+    )
+    sparse.save_npz(filename,matrix)
+
+
+def write_labels(filename,keys,samples):
+    # Row and column labels of the sparse formats
+    with open(filename+".variants.tsv","w") as O:
+        for key in keys:
+            O.write("%s\t%s\n" % key)
+    with open(filename+".samples.txt","w") as O:
+        for s in samples:
+            O.write("%s\n" % s)
 
 
 # Set up the parser
@@ -55,6 +115,9 @@ parser.add_argument('--samples',type=str,help='File with samples')
 parser.add_argument('--dir',default="results/",type=str,help='Directory containing results')
 parser.add_argument('--db',default="tbdb",type=str,help='Database name')
 parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+parser.add_argument('--store',type=str,help='Variant store created with tbprofiler_index.py (used instead of the result files)')
+parser.add_argument('--format',default="csv",choices=["csv","mtx","npz","long"],type=str,help='Output format: dense CSV, Matrix Market, scipy CSR .npz or long (variant, sample) TSV. The mtx and npz formats also write <out>.variants.tsv and <out>.samples.txt with the row and column labels')
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
@@ -8,63 +8,186 @@ import os
 from tqdm import tqdm
 import sys
 import csv
-import pathogenprofiler as pp
-import tbprofiler
+import gzip
+import functools
+from tbprofiler_utils import get_samples, get_mp_context, load_result, add_loader_args, Database
 
+# Samples with these variants in a gene are skipped for that gene
+SKIP_TYPES = ["deletion","frameshift","inframe","stop","start"]
+COMPLEMENT = str.maketrans("ACGTNacgtn","TGCANtgcan")
 
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
 
-def main(args):
-    # Get a dictionary with the database file: {"ref": "/path/to/fasta" ... etc. }
-    conf = get_conf_dict(sys.base_prefix + "/share/tbprofiler/%s" % args.db)
+def revcomp(seq):
+    return seq.translate(COMPLEMENT)[::-1]
 
-    # Get a dictionary mapping the locus_tags to drugs: {"Rv1484": ["isoniazid","ethionamide"], ... etc. }
-    locus_tag2drugs = tbprofiler.get_lt2drugs(conf["bed"])
 
-    # If a list of samples is supplied through the args object, store it in a list else get the list from looking in the results direcotry
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
-    else:
-        samples = [x.replace(args.vcf_suffix,"") for x in os.listdir(args.vcf_dir) if x[-len(args.vcf_suffix):]==args.vcf_suffix]
+def load_fai(fasta):
+    # Returns {name: (length, offset, line_bases, line_width)} from the samtools faidx index
+    fai = fasta + ".fai"
+    if not os.path.isfile(fai):
+        build_fai(fasta)
+    index = {}
+    for l in open(fai):
+        row = l.rstrip().split("\t")
+        index[row[0]] = tuple(int(x) for x in row[1:5])
+    return index
+
+
+def build_fai(fasta):
+    # Same format as samtools faidx
+    with open(fasta,"rb") as F, open(fasta+".fai","w") as O:
+        name = None
+        offset = 0
+        for l in F:
+            if l.startswith(b">"):
+                if name:
+                    O.write("%s\t%s\t%s\t%s\t%s\n" % (name,length,seq_offset,line_bases,line_width))
+                name = l[1:].split()[0].decode()
+                length = 0
+                seq_offset = offset + len(l)
+                line_bases = line_width = None
+            elif name:
+                if line_bases is None:
+                    line_bases = len(l.rstrip(b"\r\n"))
+                    line_width = len(l)
+                length += len(l.rstrip(b"\r\n"))
+            offset += len(l)
+        if name:
+            O.write("%s\t%s\t%s\t%s\t%s\n" % (name,length,seq_offset,line_bases,line_width))
+
+
+def fetch_region(fasta,index,chrom,start,end):
+    # 1-based inclusive coordinates, like samtools faidx
+    length,offset,line_bases,line_width = index[chrom]
+    start = max(start,1) - 1
+    end = min(end,length)
+    with open(fasta,"rb") as F:
+        F.seek(offset + (start // line_bases) * line_width + start % line_bases)
+        raw = F.read((end - start) + ((end - start) // line_bases + 1) * (line_width - line_bases))
+    return raw.replace(b"\n",b"").replace(b"\r",b"")[:end-start].decode().upper()
+
+
+def read_vcf_records(vcf_file):
+    # Returns {chrom: [(pos, ref, alt)]}
+    records = defaultdict(list)
+    opener = gzip.open if vcf_file.endswith(".gz") else open
+    with opener(vcf_file,"rt") as F:
+        for l in F:
+            if l[0]=="#": continue
+            row = l.split("\t",5)
+            alt = row[4].split(",")[0]
+            if alt in (".","*") or alt.startswith("<"): continue
+            records[row[0]].append((int(row[1]),row[3].upper(),alt.upper()))
+    return records
+
 
-    for l in open(conf["gff"]):
-        row = l.strip().split()
-        if len(row)<=2: continue
-        if row[2]!="gene":continue
-        if "Name=%s" % args.gene in l or "gene:%s" % args.gene in l:
-            break
+def clip_record(pos,ref,alt,start,end):
+    # Clip a record which overlaps the start or end of the region to the
+    # region. Bases of the ref and alt are paired from the left.
+    if pos<start:
+        k = start - pos
+        pos,ref,alt = start,ref[k:],alt[k:]
+    excess = pos + len(ref) - 1 - end
+    if excess>0:
+        new_ref = ref[:len(ref)-excess]
+        alt = alt[:len(new_ref)] if len(alt)<=len(ref) else alt[:len(alt)-excess]
+        ref = new_ref
+    return pos,ref,alt
 
-    start,end = int(row[3]),int(row[4])
-    # Loop through the sample result files
-    for s in tqdm(samples):
-        # Data has the same structure as the .result.json files
-        if not os.path.isfile("%s/%s%s" % (args.dir,s,args.suffix)): continue
-        data = json.load(open(pp.filecheck("%s/%s%s" % (args.dir,s,args.suffix))))
-        vars = json.dumps([d for d in data["dr_variants"]+data["other_variants"] if d["locus_tag"]==args.gene])
-        print(vars)
-        if "deletion" not in vars and "frameshift" not in vars and "inframe" not in vars and "stop" not in vars and "start" not in vars:
 
-            revseq = "| revseq  -sequence /dev/stdin  -outseq /dev/stdout" if row[6]=="-" else ""
-            pp.run_cmd("samtools faidx %s Chromosome:%s-%s | bcftools consensus %s/%s%s %s | sed 's/^>.*/>%s/' > %s.%s.fasta" % (conf["ref"],start,end,args.vcf_dir,s,args.vcf_suffix,revseq,s,s,args.gene),verbose=1)
+def apply_variants(seq,start,records):
+    # Apply the variants falling within the region starting at start. Overlapping
+    # records are skipped as bcftools consensus does.
+    new_seq = []
+    last = 0
+    for pos,ref,alt in sorted(records):
+        i = pos - start
+        if i<last or i<0 or i+len(ref)>len(seq): continue
+        new_seq.append(seq[last:i])
+        new_seq.append(alt)
+        last = i + len(ref)
+    new_seq.append(seq[last:])
+    return "".join(new_seq)
+
+
+def get_sample_sequences(s,genes,args):
+    # Returns (sample, {gene: sequence}) with the genes that can be built for this sample
+    result_file = "%s/%s%s" % (args.dir,s,args.suffix)
+    vcf_file = "%s/%s%s" % (args.vcf_dir,s,args.vcf_suffix)
+    if not os.path.isfile(result_file) or not os.path.isfile(vcf_file):
+        return s,{}
+    data = load_result(result_file,fields=["dr_variants","other_variants"])
+    skip = set()
+    for var in data["dr_variants"]+data["other_variants"]:
+        if any(t in var["type"] for t in SKIP_TYPES):
+            skip.add(var["locus_tag"])
+    records = read_vcf_records(vcf_file)
+    sequences = {}
+    for gene in genes:
+        if gene["locus_tag"] in skip: continue
+        # Deletions and MNPs which start upstream of the gene but overlap it are
+        # applied to the part inside the gene, as bcftools consensus does
+        gene_records = [
+            clip_record(pos,ref,alt,gene["start"],gene["end"])
+            for pos,ref,alt in records[gene["chrom"]] if pos<=gene["end"] and pos+len(ref)-1>=gene["start"]
+        ]
+        seq = apply_variants(gene["seq"],gene["start"],gene_records)
+        sequences[gene["gene"]] = revcomp(seq) if gene["strand"]=="-" else seq
+    return s,sequences
+
+
+def main(args):
+    # Load the database, db.conf is a dictionary with the database files: {"ref": "/path/to/fasta" ... etc. }
+    db = Database(args.db)
+
+    # If a list of samples is supplied through the args object, store it in a list else get the list from looking in the vcf direcotry
+    samples = get_samples(args.samples,args.vcf_dir,args.vcf_suffix)
+
+    # Gene coordinates come from the cached gene index of the database and the
+    # reference sequence of each gene is only read once
+    fasta_index = load_fai(db.conf["ref"])
+    genes = []
+    for gene in args.gene.split(","):
+        locus_tag = gene if gene in db.genes else db.gene2locus_tag.get(gene)
+        if locus_tag not in db.genes:
+            sys.stderr.write("Can't find %s in the database\n" % gene)
+            quit(1)
+        coords = db.genes[locus_tag]
+        genes.append(dict(
+            coords,gene=gene,locus_tag=locus_tag,
+            seq=fetch_region(db.conf["ref"],fasta_index,coords["chrom"],coords["start"],coords["end"])
+        ))
+
+    outfiles = {gene["gene"]:open("%s.%s.fasta" % (args.out,gene["gene"]),"w") for gene in genes}
+    extract = functools.partial(get_sample_sequences,genes=genes,args=args)
+    if args.workers<=1:
+        results = map(extract,samples)
+    else:
+        pool = get_mp_context().Pool(args.workers)
+        results = pool.imap(extract,samples,chunksize=max(1,min(64,len(samples)//(args.workers*8))))
+    for s,sequences in tqdm(results,total=len(samples)):
+        for gene,seq in sequences.items():
+            outfiles[gene].write(">%s\n%s\n" % (s,seq))
+    if args.workers>1:
+        pool.close()
+        pool.join()
+    for O in outfiles.values():
+        O.close()
 
 
 
 
 # Set up the parser
 parser = argparse.ArgumentParser(description='tbprofiler script',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument('--gene',type=str,help='File with samples',required=True)
+parser.add_argument('--gene',type=str,help='Comma separated gene names or locus tags',required=True)
+parser.add_argument('--out',default="gene_sequences",type=str,help='Output prefix. One multi-FASTA file is written per gene: <out>.<gene>.fasta')
 parser.add_argument('--samples',type=str,help='File with samples')
 parser.add_argument('--dir',default="results/",type=str,help='Directory containing results')
 parser.add_argument('--vcf-dir',default="results/",type=str,help='Directory containing results')
 parser.add_argument('--db',default="tbdb",type=str,help='Database name')
 parser.add_argument('--vcf-suffix',default=".targets.vcf.gz",type=str,help='File suffix')
 parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
@@ -3,31 +3,17 @@ import json
 from collections import defaultdict
 import argparse
 import os
-from tqdm import tqdm
 import sys
 import csv
-import pathogenprofiler as pp
+from tbprofiler_utils import get_samples, load_results, add_loader_args, Database
 import re
 
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
-
-
 def main(args):
-    conf = get_conf_dict(sys.base_prefix + "/share/tbprofiler/%s" % args.db)
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
-    else:
-        samples = [x.replace(args.suffix,"") for x in os.listdir(args.dir) if x[-len(args.suffix):]==args.suffix]
+    db = Database(args.db)
+    samples = get_samples(args.samples,args.dir,args.suffix)
 
     aa2genome_pos = defaultdict(list)
-    for s in tqdm(samples):
-        data = json.load(open(pp.filecheck("%s/%s%s" % (args.dir,s,args.suffix))))
+    for s,data in load_results(samples,args.dir,args.suffix,workers=args.workers):
 
         if args.dr_only:
             pool = data["dr_variants"]
@@ -48,6 +34,7 @@ parser.add_argument('--dir',default="results/",type=str,help='Directory containi
 parser.add_argument('--db',default="tbdb",type=str,help='Database name')
 parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
 parser.add_argument('--dr-only',action="store_true",help="Only extract drug resistance associated variants")
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
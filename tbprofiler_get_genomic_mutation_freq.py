@@ -5,8 +5,10 @@ import argparse
 import os
 from tqdm import tqdm
 import sys
-import pathogenprofiler as pp
+from tbprofiler_utils import get_samples, load_results, add_loader_args, Database
 import csv
+import functools
+import numpy as np
 
 try:
     sys.base_prefix
@@ -14,61 +16,85 @@ except:
     sys.base_prefix = getattr(sys, 'base_prefix', getattr(sys, 'real_prefix', sys.prefix))
 
 
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
+# Number of set bits in every possible byte
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)],dtype=np.uint32)
 
 
+def get_sample_variants(data,group_by):
+    group = data.get(group_by,"NA") if group_by else "NA"
+    return str(group),[(var["genome_pos"],var["change"]) for var in data["dr_variants"]+data["other_variants"]]
+
+
+def get_carrier_bitsets(positions,carriers,num_samples):
+    # Packed bitset of carrier samples for each position, one row per position
+    bitsets = np.zeros((len(positions),num_samples),dtype=bool)
+    for i,pos in enumerate(positions):
+        bitsets[i,list(carriers[pos])] = True
+    return np.packbits(bitsets,axis=1)
+
 
 def main(args):
     if args.drugs:
         args.drugs = [x.lower() for x in args.drugs.split(",")]
-    conf = get_conf_dict(sys.base_prefix + "/share/tbprofiler/%s" % args.db)
+    db = Database(args.db)
 
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
-    else:
-        samples = [x.replace(".results.json","") for x in os.listdir(args.dir) if x[-13:]==".results.json"]
+    samples = get_samples(args.samples,args.dir,args.suffix)
+    sample_index = {s:i for i,s in enumerate(samples)}
 
-    variants = defaultdict(set)
-    variant_drug_associations = defaultdict(set)
-    drtypes = defaultdict(set)
+    meta = {}
+    if args.meta:
+        for row in csv.DictReader(open(args.meta)):
+            meta[row[args.meta_id]] = row[args.group_by]
+
+    # Samples are given integer IDs and each position keeps the IDs of its carriers.
+    # A sample with several changes at a position is only counted once.
+    carriers = defaultdict(set)
     genome_pos2changes = defaultdict(set)
-    for s in tqdm(samples):
-        tmp = json.load(open(f"{args.dir}/{s}.results.json"))
-        drtypes[tmp["drtype"]].add(s)
-        for var in tmp["dr_variants"]+tmp["other_variants"]:
-            variants[var["genome_pos"]].add(s)
-            genome_pos2changes[var["genome_pos"]].add(var["change"])
+    sample_groups = {}
+    extract = functools.partial(get_sample_variants,group_by=None if args.meta else args.group_by)
+    for s,(group,sample_variants) in load_results(samples,args.dir,args.suffix,extract=extract,workers=args.workers):
+        i = sample_index[s]
+        sample_groups[s] = meta.get(s,"NA") if args.meta else group
+        for pos,change in sample_variants:
+            carriers[pos].add(i)
+            genome_pos2changes[pos].add(change)
+
+    # Keep the groups in the order they are first seen
+    groups = list(dict.fromkeys(sample_groups[s] for s in samples))
+    group_bitsets = {}
+    group_size = {}
+    for group in groups:
+        mask = np.zeros(len(samples),dtype=bool)
+        mask[[sample_index[s] for s in samples if sample_groups[s]==group]] = True
+        group_bitsets[group] = np.packbits(mask)
+        group_size[group] = int(mask.sum())
 
     total_sample_n = len(samples)
+    positions = sorted(carriers)
     OUT = open(args.outfile,"w")
     OUT.write("pos\tchange\ttotal_num\ttotal_af\t%s\t%s\n" % (
-        "\t".join(["%s_num" % d for d in  drtypes]),
-        "\t".join(["%s_af" % d for d in  drtypes])
+        "\t".join(["%s_num" % d for d in  groups]),
+        "\t".join(["%s_af" % d for d in  groups])
     ))
-    for pos in tqdm(sorted(variants)):
-        total_num = len(variants[pos])
-        af = total_num/total_sample_n
-        sub_af = {}
-        sub_num = {}
-        for drtype in drtypes:
-            mut = len([s for s in drtypes[drtype] if s in variants[pos]])
-            no_mut = len([s for s in drtypes[drtype] if s not in variants[pos]])
-            sub_num[drtype] = mut
-            sub_af[drtype] = mut/(mut+no_mut) if (mut+no_mut)>0 else "NA"
-        OUT.write("%s\t%s\t%s\t%s\t%s\t%s\n" % (
-            pos,
-            ",".join(genome_pos2changes[pos]),
-            total_num,
-            af,
-            "\t".join([str(sub_num[d]) for d in drtypes]),
-            "\t".join([str(sub_af[d]) for d in drtypes])
-        ))
+    for chunk_start in tqdm(range(0,len(positions),args.chunk_size)):
+        chunk = positions[chunk_start:chunk_start+args.chunk_size]
+        bitsets = get_carrier_bitsets(chunk,carriers,total_sample_n)
+        # Carriers in each group are the popcount of the position and group bitsets ANDed
+        group_num = {group:POPCOUNT[bitsets & group_bitsets[group]].sum(axis=1) for group in groups}
+        total_nums = POPCOUNT[bitsets].sum(axis=1)
+        for i,pos in enumerate(chunk):
+            total_num = int(total_nums[i])
+            af = total_num/total_sample_n
+            sub_num = {d:int(group_num[d][i]) for d in groups}
+            sub_af = {d:sub_num[d]/group_size[d] if group_size[d]>0 else "NA" for d in groups}
+            OUT.write("%s\t%s\t%s\t%s\t%s\t%s\n" % (
+                pos,
+                ",".join(genome_pos2changes[pos]),
+                total_num,
+                af,
+                "\t".join([str(sub_num[d]) for d in groups]),
+                "\t".join([str(sub_af[d]) for d in groups])
+            ))
     OUT.close()
 parser = argparse.ArgumentParser(description='TBProfiler pipeline',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('--outfile',type=str,help='NGS Platform',required=True)
@@ -76,6 +102,12 @@ parser.add_argument('--samples',type=str,help='NGS Platform')
 parser.add_argument('--dir',default="results/",type=str,help='NGS Platform')
 parser.add_argument('--db',default="tbdb",type=str,help='NGS Platform')
 parser.add_argument('--drugs',type=str,help='NGS Platform')
+parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+parser.add_argument('--group-by',default="drtype",type=str,help='Field of the result files (e.g. drtype, main_lin, sublin) or column of the --meta file to stratify the frequencies by')
+parser.add_argument('--meta',type=str,help='CSV file with sample meta data to stratify by the --group-by column')
+parser.add_argument('--meta-id',default="id",type=str,help='Column of the --meta file with the sample IDs')
+parser.add_argument('--chunk-size',default=1000,type=int,help='Number of positions counted at once')
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
@@ -9,90 +9,128 @@ from tqdm import tqdm
 import sys
 import csv
 import pathogenprofiler as pp
-import tbprofiler
+from tbprofiler_utils import get_samples, load_results, add_loader_args, Database
 import statistics
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+def get_query_hits(data,queries):
+    # Return (query, genome_pos) for every variant matching one of the (gene, variant) queries
+    hits = []
+    for var in data["dr_variants"] + data["other_variants"]:
+        for key in set([(var["gene"],var["change"]),(var["locus_tag"],var["change"])]):
+            if key in queries:
+                hits.append((key,var["genome_pos"]))
+    return hits
+
+
+def annotate_sample(sample,positions,args,ref):
+    # Annotate all target positions of a sample with a single GATK run and
+    # return a {position: ReadPosRankSum} dictionary
+    params = vars(args).copy()
+    params["ref"] = ref
+    params["sample"] = sample
+    params["tmp_vcf"] = pp.get_random_file(extension=".vcf.gz")
+    params["tmp_regions"] = pp.get_random_file(extension=".txt")
+    with open(params["tmp_regions"],"w") as O:
+        for pos in sorted(positions):
+            O.write("Chromosome\t%s\n" % pos)
+    pp.run_cmd("tabix -f %(vcf_dir)s/%(sample)s.targets.csq.vcf.gz" % params,verbose=0)
+    pp.run_cmd("bcftools view %(vcf_dir)s/%(sample)s.targets.csq.vcf.gz -R %(tmp_regions)s -Oz -o %(tmp_vcf)s" % params,verbose=0)
+    pp.run_cmd("tabix -f %(tmp_vcf)s" % params,verbose=0)
+    values = {}
+    for l in pp.cmd_out("gatk VariantAnnotator -R %(ref)s -I %(bam_dir)s/%(sample)s%(bam_extension)s -V %(tmp_vcf)s -O /dev/stdout -A ReadPosRankSumTest -OVI false  | bcftools query -f '%%POS\\t%%ReadPosRankSum\\n'" % params,verbose=0):
+        row = l.strip().split()
+        if row[1]==".": continue
+        if int(row[0]) in positions:
+            values[int(row[0])] = float(row[1])
+    pp.rm_files([params["tmp_vcf"],params["tmp_vcf"]+".tbi",params["tmp_regions"]])
+    return values
 
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
 
 def main(args):
-    # Get a dictionary with the database file: {"ref": "/path/to/fasta" ... etc. }
-    conf = get_conf_dict(sys.base_prefix + "/share/tbprofiler/%s" % args.db)
+    # Load the database, db.conf is a dictionary with the database files: {"ref": "/path/to/fasta" ... etc. }
+    db = Database(args.db)
 
     # Get a dictionary mapping the locus_tags to drugs: {"Rv1484": ["isoniazid","ethionamide"], ... etc. }
-    locus_tag2drugs = tbprofiler.get_lt2drugs(conf["bed"])
+    locus_tag2drugs = db.locus_tag2drugs
 
-    # If a list of samples is supplied through the args object, store it in a list else get the list from looking in the results direcotry
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
+    # Either a single --gene/--variant pair or a file with one gene<tab>variant pair per line
+    if args.variants:
+        queries = []
+        for l in open(args.variants):
+            row = l.rstrip("\n").split("\t")
+            if len(row)<2: continue
+            queries.append((row[0],row[1]))
+    elif args.gene and args.variant:
+        queries = [(args.gene,args.variant)]
     else:
-        samples = [x.replace(args.suffix,"") for x in os.listdir(args.results_dir) if x[-len(args.suffix):]==args.suffix]
+        sys.stderr.write("Please provide --gene and --variant or a --variants file\n")
+        quit(1)
 
-    # Loop through the sample result files
-    samples_with_mutation = []
-    variant_position_set = set()
-    for s in tqdm(samples):
-        # Data has the same structure as the .result.json files
-        data = json.load(open(pp.filecheck("%s/%s%s" % (args.results_dir,s,args.suffix))))
-        for var in data["dr_variants"] + data["other_variants"]:
-            if (var["gene"]==args.gene or var["locus_tag"]==args.gene) and var["change"]==args.variant:
-                samples_with_mutation.append(s)
-                variant_position_set.add(var["genome_pos"])
+    # If a list of samples is supplied through the args object, store it in a list else get the list from looking in the results direcotry
+    samples = get_samples(args.samples,args.results_dir,args.suffix)
 
-    sys.stderr.write("\nFound %s samples with mutation\n" % len(samples_with_mutation))
-    # samples_with_mutation = ["ERR2515541","ERR2510504","ERR2864225","SRR7341698"]
-    if len(samples_with_mutation)==0:
-        sys.stdout.write("%s\t%s\t%s\n" % (args.gene,args.variant,"Mutation_not_found"))
-        quit()
-    elif len(variant_position_set)>1:
-        sys.stdout.write("%s\t%s\t%s\n" % (args.gene,args.variant,"Multiple_genome_pos"))
-        quit()
+    # Loop through the sample result files
+    samples_with_mutation = defaultdict(list)
+    variant_position_set = defaultdict(set)
+    extract = functools.partial(get_query_hits,queries=frozenset(queries))
+    for s,hits in load_results(samples,args.results_dir,args.suffix,extract=extract,workers=args.workers):
+        for key,pos in hits:
+            samples_with_mutation[key].append(s)
+            variant_position_set[key].add(pos)
 
+    # Work out which positions need to be annotated in each sample
+    status = {}
+    variant_position = {}
+    sample_positions = defaultdict(set)
+    for key in queries:
+        sys.stderr.write("\nFound %s samples with mutation %s %s\n" % (len(samples_with_mutation[key]),key[0],key[1]))
+        if len(samples_with_mutation[key])==0:
+            status[key] = "Mutation_not_found"
+        elif len(variant_position_set[key])>1:
+            status[key] = "Multiple_genome_pos"
+        else:
+            variant_position[key] = int(list(variant_position_set[key])[0])
+            for s in samples_with_mutation[key]:
+                sample_positions[s].add(variant_position[key])
 
-    if len(variant_position_set)==1:
-        variant_position = int(list(variant_position_set)[0])
+    sys.stderr.write("\nPerforming ReadPosRankSum test on %s samples\n" % len(sample_positions))
+    # Each sample is annotated once with all of its positions. The work is done
+    # by external tools so a thread pool is enough to run samples concurrently.
+    sample_values = {}
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(annotate_sample,s,sample_positions[s],args,db.conf["ref"]):s for s in sample_positions}
+        for future in tqdm(as_completed(futures),total=len(futures)):
+            sample_values[futures[future]] = future.result()
 
-    sys.stderr.write("\nGenome position is %s\n" % variant_position)
-    sys.stderr.write("\nPerforming ReadPosRankSum test\n")
-    # variant_position = 3841662
-    params = vars(args)
-    params["ref"] = conf["ref"]
-    params["pos"] = variant_position
-    params["tmp_vcf"] = pp.get_random_file(extension=".vcf.gz")
-    read_pos_rank_sums = []
-    for s in tqdm(samples_with_mutation):
-        params["sample"] = s
-        pp.run_cmd("tabix -f %(vcf_dir)s/%(sample)s.targets.csq.vcf.gz" % params,verbose=0)
-        pp.run_cmd("bcftools view %(vcf_dir)s/%(sample)s.targets.csq.vcf.gz Chromosome:%(pos)s -Oz -o %(tmp_vcf)s" % params,verbose=0)
-        pp.run_cmd("tabix -f %(tmp_vcf)s" % params,verbose=0)
-        for l in pp.cmd_out("gatk VariantAnnotator -R %(ref)s -I %(bam_dir)s/%(sample)s%(bam_extension)s -V %(tmp_vcf)s -O /dev/stdout -A ReadPosRankSumTest -OVI false  | bcftools query -f '%%POS\\t%%ReadPosRankSum\\n'" % params,verbose=0):
-            row = l.strip().split()
-            if row[1]==".": continue
-            if int(row[0])==variant_position:
-                read_pos_rank_sums.append((s,float(row[1])))
-
-    if len(read_pos_rank_sums)==0:
-        sys.stdout.write("%s\t%s\t%s\n" % (args.gene,args.variant,"No_values_from_samples"))
-    else:
-        sys.stdout.write("%s\t%s\t%s\n" % (args.gene,args.variant,statistics.median([x[1] for x in read_pos_rank_sums])))
-    pp.rm_files([params["tmp_vcf"]])
+    for key in queries:
+        if key in status:
+            sys.stdout.write("%s\t%s\t%s\n" % (key[0],key[1],status[key]))
+            continue
+        read_pos_rank_sums = []
+        for s in samples_with_mutation[key]:
+            if variant_position[key] in sample_values[s]:
+                read_pos_rank_sums.append((s,sample_values[s][variant_position[key]]))
+        if len(read_pos_rank_sums)==0:
+            sys.stdout.write("%s\t%s\t%s\n" % (key[0],key[1],"No_values_from_samples"))
+        else:
+            sys.stdout.write("%s\t%s\t%s\n" % (key[0],key[1],statistics.median([x[1] for x in read_pos_rank_sums])))
 
 # Set up the parser
 parser = argparse.ArgumentParser(description='tbprofiler script',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('--samples',type=str,help='File with samples')
-parser.add_argument('--gene',type=str,help='Directory containing results',required=True)
-parser.add_argument('--variant',type=str,help='Directory containing vsfs',required=True)
+parser.add_argument('--gene',type=str,help='Gene')
+parser.add_argument('--variant',type=str,help='Variant')
+parser.add_argument('--variants',type=str,help='Tab separated file with gene and variant columns to process in a single run (instead of --gene/--variant)')
 parser.add_argument('--results-dir',type=str,help='Directory containing results',required=True)
 parser.add_argument('--vcf-dir',type=str,help='Directory containing vsfs',required=True)
 parser.add_argument('--bam-dir',type=str,help='Directory containing bams',required=True)
 parser.add_argument('--bam-extension',default=".bqsr.cram",type=str,help='Extension to bams')
 parser.add_argument('--db',default="tbdb",type=str,help='Database name')
 parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+parser.add_argument('--jobs',default=1,type=int,help='Number of samples to annotate concurrently')
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
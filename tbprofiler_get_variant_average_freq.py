@@ -5,66 +5,84 @@ import json
 from collections import defaultdict
 import argparse
 import os
-from tqdm import tqdm
 import sys
 import csv
-import pathogenprofiler as pp
-import tbprofiler
+from tbprofiler_utils import get_samples, load_results, add_loader_args, Database
 import statistics
+import functools
+
+def get_query_hits(data,queries):
+    # Return (query, freq, annotations) for every variant matching one of the
+    # (gene, variant) queries. Genes can be given as names or locus_tags.
+    hits = []
+    for var in data["dr_variants"] + data["other_variants"]:
+        for key in set([(var["locus_tag"],var["change"]),(var["gene"],var["change"])]):
+            if key in queries:
+                hits.append((key,var["freq"],var.get("variant_annotations")))
+    return hits
+
+
+def median(values):
+    return statistics.median(values) if len(values)>0 else "NA"
 
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
 
 def main(args):
-    # Get a dictionary with the database file: {"ref": "/path/to/fasta" ... etc. }
-    conf = get_conf_dict(sys.base_prefix + "/share/tbprofiler/%s" % args.db)
+    # Load the database, db.conf is a dictionary with the database files: {"ref": "/path/to/fasta" ... etc. }
+    db = Database(args.db)
 
     # Get a dictionary mapping the locus_tags to drugs: {"Rv1484": ["isoniazid","ethionamide"], ... etc. }
-    locus_tag2drugs = tbprofiler.get_lt2drugs(conf["bed"])
+    locus_tag2drugs = db.locus_tag2drugs
 
-    # If a list of samples is supplied through the args object, store it in a list else get the list from looking in the results direcotry
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
+    # Either a single --gene/--variant pair or a file with one gene<tab>variant pair per line
+    if args.variants:
+        queries = []
+        for l in open(args.variants):
+            row = l.rstrip("\n").split("\t")
+            if len(row)<2: continue
+            queries.append((row[0],row[1]))
+    elif args.gene and args.variant:
+        queries = [(args.gene,args.variant)]
     else:
-        samples = [x.replace(args.suffix,"") for x in os.listdir(args.dir) if x[-len(args.suffix):]==args.suffix]
+        sys.stderr.write("Please provide --gene and --variant or a --variants file\n")
+        quit(1)
 
-    # Loop through the sample result files
-    variant_freqs = []
-    rprs = []
-    bqrs = []
-    mqrs = []
-    for s in tqdm(samples):
-        # Data has the same structure as the .result.json files
-        data = json.load(open(pp.filecheck("%s/%s%s" % (args.dir,s,args.suffix))))
-        for var in data["dr_variants"] + data["other_variants"]:
-            if (var["locus_tag"]==args.gene or var["gene"]==args.gene) and var["change"]==args.variant:
-                variant_freqs.append(var["freq"])
-                try:
-                    rprs.append(float(var["variant_annotations"]["ReadPosRankSum"]))
-                    bqrs.append(float(var["variant_annotations"]["BaseQRankSum"]))
-                    mqrs.append(float(var["variant_annotations"]["MQRankSum"]))
-                except:
-                    pass
+    # If a list of samples is supplied through the args object, store it in a list else get the list from looking in the results direcotry
+    samples = get_samples(args.samples,args.dir,args.suffix)
 
-    if len(variant_freqs)>0:
-        print("%s\t%s\t%s\t%s\t%s\t%s\t%s" % (args.gene,args.variant,len(variant_freqs),statistics.median(variant_freqs),statistics.median(rprs),statistics.median(bqrs),statistics.median(mqrs)))
-    else:
-        print("%s\t%s\tNA\tNA\tNA\tNA\tNA" % (args.gene,args.variant))
+    # Loop through the sample result files once and collect the values for all queries
+    variant_freqs = {q:[] for q in queries}
+    rprs = {q:[] for q in queries}
+    bqrs = {q:[] for q in queries}
+    mqrs = {q:[] for q in queries}
+    extract = functools.partial(get_query_hits,queries=frozenset(queries))
+    for s,hits in load_results(samples,args.dir,args.suffix,extract=extract,workers=args.workers):
+        for key,freq,annotations in hits:
+            variant_freqs[key].append(freq)
+            try:
+                rprs[key].append(float(annotations["ReadPosRankSum"]))
+                bqrs[key].append(float(annotations["BaseQRankSum"]))
+                mqrs[key].append(float(annotations["MQRankSum"]))
+            except:
+                pass
+
+    for gene,variant in queries:
+        key = (gene,variant)
+        if len(variant_freqs[key])>0:
+            print("%s\t%s\t%s\t%s\t%s\t%s\t%s" % (gene,variant,len(variant_freqs[key]),median(variant_freqs[key]),median(rprs[key]),median(bqrs[key]),median(mqrs[key])))
+        else:
+            print("%s\t%s\tNA\tNA\tNA\tNA\tNA" % (gene,variant))
 
 
 # Set up the parser
 parser = argparse.ArgumentParser(description='tbprofiler script',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument('--gene',type=str,help='Gene',required=True)
-parser.add_argument('--variant',type=str,help='Variant',required=True)
+parser.add_argument('--gene',type=str,help='Gene')
+parser.add_argument('--variant',type=str,help='Variant')
+parser.add_argument('--variants',type=str,help='Tab separated file with gene and variant columns to process in a single pass (instead of --gene/--variant)')
 parser.add_argument('--samples',type=str,help='File with samples')
 parser.add_argument('--dir',default="results/",type=str,help='Directory containing results')
 parser.add_argument('--db',default="tbdb",type=str,help='Database name')
 parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
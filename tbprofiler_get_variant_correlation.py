@@ -6,74 +6,93 @@ import os
 from tqdm import tqdm
 import sys
 import csv
-import pathogenprofiler as pp
-from itertools import chain
+from tbprofiler_utils import get_samples, load_results, add_loader_args, Database, test_2x2_tables, get_mp_context
+import functools
+import numpy as np
+from scipy import sparse
 
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
+def get_drug_haplotypes(data,gene2drugs):
+    # Returns {drug: (mutation, ...)} with the mutations found in the genes of each drug
+    sample_drug_haplotypes = defaultdict(set)
+    for var in data["dr_variants"]:
+        for d in var["drugs"]:
+            sample_drug_haplotypes[d["drug"]].add((var["gene"],var["change"]))
+    for var in data["other_variants"]:
+        if var["type"]=="synonymous": continue
+        for drug in gene2drugs.get(var["gene"],[]):
+            sample_drug_haplotypes[drug].add((var["gene"],var["change"]))
+    return {drug:tuple(sorted(muts)) for drug,muts in sample_drug_haplotypes.items()}
 
 
-def main(args):
-    conf = get_conf_dict(sys.base_prefix + "/share/tbprofiler/%s" % args.db)
-    drug2genes = defaultdict(set)
-    gene2drugs = defaultdict(set)
-    for l in open(conf["bed"]):
-        row = l.strip().split()
-        for drug in row[5].split(","):
-            drug2genes[drug].add(row[4])
-            gene2drugs[row[4]].add(drug)
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
+def get_drug_tables(task):
+    # Build a haplotype x mutation matrix and get all mutation pair counts
+    # from one product weighted by the number of samples with each haplotype
+    drug,haplotypes,min_count = task
+    mutation_index = {}
+    rows,cols,weights = [],[],[]
+    for i,(haplotype,count) in enumerate(haplotypes.items()):
+        weights.append(count)
+        for mut in haplotype:
+            rows.append(i)
+            cols.append(mutation_index.setdefault(mut,len(mutation_index)))
+    mutations = list(mutation_index)
+    H = sparse.csr_matrix((np.ones(len(rows)),(rows,cols)),shape=(len(weights),len(mutations)))
+    W = sparse.diags(np.asarray(weights,dtype=float))
+    counts = (H.T @ W @ H).tocsr()
+    totals = counts.diagonal()
+    n = sum(weights)
+
+    if min_count>0:
+        pairs = sparse.triu(counts,k=1).tocoo()
+        keep = pairs.data>=min_count
+        idx1,idx2,both = pairs.row[keep],pairs.col[keep],pairs.data[keep]
     else:
-        samples = [x.replace(args.suffix,"") for x in os.listdir(args.dir) if x[-len(args.suffix):]==args.suffix]
-    drug_haplotypes = {drug:defaultdict(int) for drug in drug2genes}
-    for s in tqdm(samples):
-        sample_drug_haplotypes = {drug:set() for drug in drug2genes}
-        data = json.load(open(pp.filecheck("%s/%s%s" % (args.dir,s,args.suffix))))
-        for var in data["dr_variants"]:
-            sample_drug_haplotypes[drug].add((var["gene"],var["change"]))
-        for var in data["other_variants"]:
-            if var["type"]=="synonymous": continue
-            for drug in gene2drugs[var["gene"]]:
-                sample_drug_haplotypes[drug].add((var["gene"],var["change"]))
-        for drug in drug2genes:
-            if len(sample_drug_haplotypes[drug])>0:
-                drug_haplotypes[drug][tuple(sample_drug_haplotypes[drug])]+=1
+        # Pairs never seen together are reported as well, their counts are
+        # read from the sparse matrix without making it dense
+        idx1,idx2 = np.triu_indices(len(mutations),k=1)
+        both = np.asarray(counts[idx1,idx2]).ravel()
 
-    for drug in drug2genes:
-        mutations = set(chain(*drug_haplotypes[drug]))
-        for m1 in tqdm(mutations):
-            for m2 in mutations:
-                table = [[0,0],[0,0]]
-                for haplotype in drug_haplotypes[drug]:
-                    if m1 not in haplotype and m2 not in haplotype:
-                        table[0][0] += drug_haplotypes[drug][haplotype]
-                    if m1 in haplotype and m2 not in haplotype:
-                        table[1][0] += drug_haplotypes[drug][haplotype]
-                    if m1 not in haplotype and m2 in haplotype:
-                        table[1][0] += drug_haplotypes[drug][haplotype]
-                    if m1 in haplotype and m2 in haplotype:
-                        table[1][1] += drug_haplotypes[drug][haplotype]
-                print("%s_%s - %s_%s" % (m1[0],m1[1],m2[0],m2[1]), table)
+    odds_ratio,or_pval,pval = test_2x2_tables(both,totals[idx1],totals[idx2],n)
+    rows = []
+    for i in range(len(both)):
+        m1,m2 = mutations[idx1[i]],mutations[idx2[i]]
+        rows.append([
+            drug,"%s_%s" % m1,"%s_%s" % m2,int(totals[idx1[i]]),int(totals[idx2[i]]),int(both[i]),
+            odds_ratio[i],or_pval[i],"NA" if np.isnan(pval[i]) else pval[i]
+        ])
+    return rows
+
+
+def main(args):
+    db = Database(args.db)
+    drug2genes = db.drug2genes
+    gene2drugs = db.gene2drugs
+    samples = get_samples(args.samples,args.dir,args.suffix)
+    drug_haplotypes = {drug:defaultdict(int) for drug in drug2genes}
+    extract = functools.partial(get_drug_haplotypes,gene2drugs=gene2drugs)
+    for s,sample_drug_haplotypes in load_results(samples,args.dir,args.suffix,extract=extract,workers=args.workers):
+        for drug,haplotype in sample_drug_haplotypes.items():
+            if drug in drug_haplotypes:
+                drug_haplotypes[drug][haplotype]+=1
 
-        # for haplotype in drug_haplotypes[drug]:
-        #     print("%s\t%s\t%s" % (
-        #         drug,
-        #         "__".join(["%s:%s" % (g,c) for g,c in haplotype]),
-        #         drug_haplotypes[drug][haplotype]
-        #     ))
+    # The tables of each drug are independent so the drugs are processed in parallel
+    tasks = [(drug,dict(drug_haplotypes[drug]),args.min_count) for drug in sorted(drug_haplotypes) if len(drug_haplotypes[drug])>0]
+    with open(args.out,"w") as O:
+        writer = csv.writer(O,delimiter="\t")
+        writer.writerow(["drug","mutation1","mutation2","total_mutation1","total_mutation2","both","odds_ratio","odds_ratio_pval","pval"])
+        with get_mp_context().Pool(args.workers) as pool:
+            for rows in tqdm(pool.imap(get_drug_tables,tasks),total=len(tasks)):
+                writer.writerows(rows)
 
 
 parser = argparse.ArgumentParser(description='tbprofiler script',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--out',type=str,help='Output TSV file',required=True)
 parser.add_argument('--samples',type=str,help='File with samples')
 parser.add_argument('--dir',default="results/",type=str,help='Directory containing results')
 parser.add_argument('--db',default="tbdb",type=str,help='Database name')
 parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+parser.add_argument('--min-count',default=1,type=int,help='Only report pairs of mutations found together in at least this many samples (0 reports all pairs)')
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
@@ -0,0 +1,30 @@
+#! /usr/bin/env python
+
+# Load useful libraries
+import argparse
+import sys
+from tbprofiler_utils import get_samples, load_results, add_loader_args, get_variant_rows, write_variant_store
+
+
+def main(args):
+    # If a list of samples is supplied through the args object, store it in a list else get the list from looking in the results direcotry
+    samples = get_samples(args.samples,args.dir,args.suffix)
+
+    # Build the rows inside the loader workers and write them out in batches
+    # so that the full result dicts are never held in memory together
+    records = load_results(samples,args.dir,args.suffix,extract=get_variant_rows,workers=args.workers)
+    write_variant_store(args.out,samples,records)
+    sys.stderr.write("Written variant store for %s samples to %s\n" % (len(samples),args.out))
+
+
+# Set up the parser
+parser = argparse.ArgumentParser(description='Convert a results directory into a columnar variant store (Parquet or Arrow IPC)',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--out',default="variants.parquet",type=str,help='Output file. Files ending with .parquet are written as Parquet, otherwise Arrow IPC is used')
+parser.add_argument('--samples',type=str,help='File with samples')
+parser.add_argument('--dir',default="results/",type=str,help='Directory containing results')
+parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+add_loader_args(parser)
+parser.set_defaults(func=main)
+
+args = parser.parse_args()
+args.func(args)
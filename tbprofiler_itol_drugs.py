@@ -5,21 +5,11 @@ import json
 from collections import defaultdict,Counter
 import argparse
 import os
-from tqdm import tqdm
 import sys
 import csv
-import pathogenprofiler as pp
-import tbprofiler
+from tbprofiler_utils import get_samples, load_results, add_loader_args, Database
 
 
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
-
 def main(args):
     mapping = {
         "missense":"SNP",
@@ -32,19 +22,16 @@ def main(args):
         "inframe_insertion":"indel",
         "large_deletion":"large_deletion"
     }
-    conf = get_conf_dict(sys.base_prefix + "/share/tbprofiler/%s" % args.db)
-    locus_tag2drugs = tbprofiler.get_lt2drugs(conf["bed"])
+    db = Database(args.db)
+    locus_tag2drugs = db.locus_tag2drugs
 
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
-    else:
-        samples = [x.replace(args.suffix,"") for x in os.listdir(args.dir) if x[-len(args.suffix):]==args.suffix]
+    samples = get_samples(args.samples,args.dir,args.suffix)
 
     resistance = defaultdict(lambda:defaultdict(list))
-    for s in tqdm(samples):
-        data = json.load(open(pp.filecheck("%s/%s%s" % (args.dir,s,args.suffix))))
+    for s,data in load_results(samples,args.dir,args.suffix,workers=args.workers):
         for var in data["dr_variants"]:
-            resistance[var["drug"]][s].append(mapping.get(var["type"],"complex"))
+            for d in var["drugs"]:
+                resistance[d["drug"]][s].append(mapping.get(var["type"],"complex"))
 
     for drug in resistance:
         lines = []
@@ -74,6 +61,7 @@ parser.add_argument('--samples',type=str,help='File with samples')
 parser.add_argument('--dir',default="results/",type=str,help='Directory containing results')
 parser.add_argument('--db',default="tbdb",type=str,help='Database name')
 parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
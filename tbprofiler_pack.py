@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+
+# Load useful libraries
+import argparse
+import os
+import sys
+from tqdm import tqdm
+from tbprofiler_utils import get_samples, get_mp_context, get_archive_codec, read_archive_index, filecheck
+
+
+def compress_file(task):
+    filename,codec,level = task
+    with open(filecheck(filename),"rb") as F:
+        return get_archive_codec(codec,level)[0](F.read())
+
+
+def repair_index(filename):
+    # Remove a partial last line left by an interrupted run
+    with open(filename,"rb+") as F:
+        content = F.read()
+        if content and not content.endswith(b"\n"):
+            F.truncate(content.rfind(b"\n")+1)
+
+
+def main(args):
+    # If a list of samples is supplied through the args object, store it in a list else get the list from looking in the results direcotry
+    samples = get_samples(args.samples,args.dir,args.suffix)
+
+    # Samples are appended to an existing archive, keeping its codec
+    if os.path.isfile(args.out + ".idx"):
+        repair_index(args.out + ".idx")
+        codec,index = read_archive_index(args.out)
+        if not args.overwrite:
+            samples = [s for s in samples if s not in index]
+    else:
+        codec = args.codec
+        with open(args.out + ".idx","w") as O:
+            O.write("#codec\t%s\n" % codec)
+
+    tasks = [("%s/%s%s" % (args.dir,s,args.suffix),codec,args.level) for s in samples]
+    with get_mp_context().Pool(args.workers) as pool, open(args.out,"ab") as O, open(args.out + ".idx","a") as I:
+        chunksize = max(1,min(64,len(tasks)//(args.workers*8)))
+        for s,record in zip(samples,tqdm(pool.imap(compress_file,tasks,chunksize=chunksize),total=len(tasks))):
+            offset = O.tell()
+            O.write(record)
+            O.flush()
+            # The index line is only written once the record is on disk so an
+            # interrupted run can be restarted
+            I.write("%s\t%s\t%s\n" % (s,offset,len(record)))
+            I.flush()
+    sys.stderr.write("Added %s samples to %s\n" % (len(samples),args.out))
+
+
+# Set up the parser
+parser = argparse.ArgumentParser(description='Pack a results directory into a single compressed archive which can be used in place of the directory',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--out',default="results.tbpa",type=str,help='Archive file. The index is written to <out>.idx')
+parser.add_argument('--samples',type=str,help='File with samples')
+parser.add_argument('--dir',default="results/",type=str,help='Directory containing results')
+parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+parser.add_argument('--codec',default="zstd",choices=["zstd","zlib"],type=str,help='Compression used for new archives (zstd requires the zstandard package)')
+parser.add_argument('--level',default=3,type=int,help='Compression level')
+parser.add_argument('--overwrite',action="store_true",help='Add samples which are already in the archive again (the new record is used)')
+parser.add_argument('--workers',default=1,type=int,help='Number of processes used to compress the result files')
+parser.set_defaults(func=main)
+
+args = parser.parse_args()
+args.func(args)
@@ -5,11 +5,9 @@ import json
 from collections import defaultdict
 import argparse
 import os
-from tqdm import tqdm
 import sys
 import csv
-import pathogenprofiler as pp
-import tbprofiler
+from tbprofiler_utils import get_samples, load_results, add_loader_args, Database
 
 def camel_case(c):
     d = list(c.replace("_"," ").replace("-", " ").title().replace(" ",""))
@@ -17,37 +15,114 @@ def camel_case(c):
     d = "".join(d)
     return d
 
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
-
-def uniq_dict_list(l):
-    return [json.loads(j) for j in set([json.dumps(d) for d in l])]
-
-def standardise_types(dictlist):
-    new_dict_list = []
-    id2type = defaultdict(set)
-    for row in dictlist:
-        id2type[row["id"]].add(row["type"])
-    for row in dictlist:
-        if id2type[row["id"]]==set(["frameshift","inframe_insertion"]):
-            if row["type"]=="inframe_insertion": continue
-        elif id2type[row["id"]]==set(["frameshift","inframe_deletion"]):
-            if row["type"]=="inframe_deletion": continue
-        new_dict_list.append(row)
-    return new_dict_list
+def add_variant_node(variant_nodes,node):
+    # Variant nodes are stored once per variant ID and type
+    variant_nodes.setdefault(node["id"],{}).setdefault(node["type"],node)
+
+def standardise_types(types):
+    # Variants which are called as frameshift in some samples and inframe in
+    # others are kept as frameshift only
+    if set(types)==set(["frameshift","inframe_insertion"]):
+        return ["frameshift"]
+    elif set(types)==set(["frameshift","inframe_deletion"]):
+        return ["frameshift"]
+    return list(types)
+
+def iter_variant_nodes(variant_nodes):
+    for types in variant_nodes.values():
+        for t in standardise_types(types):
+            yield types[t]
+
+
+# Field names and neo4j-admin import header of the node and relationship files.
+# Nodes use a separate ID space per label.
+SAMPLE_VARIANT_EDGE_FIELDS = ["sampleId","variantId","freq","genome_pos","nucleotideChange","internalChange"]
+ADMIN_HEADERS = {
+    "sampleId": ":START_ID(Sample)",
+    "variantId": ":END_ID(Variant)",
+    "freq": "freq:float",
+    "genome_pos": "genome_pos:int",
+}
+
+
+class ChunkedCSVWriter:
+    # Writes rows as they are generated, starting a new file every chunk_size
+    # rows (or a single file if chunk_size is None)
+    def __init__(self,prefix,fieldnames,chunk_size=None,header=None):
+        self.prefix = prefix
+        self.fieldnames = fieldnames
+        self.chunk_size = chunk_size
+        self.header = header if header else fieldnames
+        self.num_rows = 0
+        self.files = []
+        self.handle = None
+
+    def new_file(self):
+        if self.handle:
+            self.handle.close()
+        filename = "%s.%s.csv" % (self.prefix,len(self.files)) if self.chunk_size else "%s.csv" % self.prefix
+        self.files.append(filename)
+        self.handle = open(filename,"w")
+        csv.writer(self.handle).writerow(self.header)
+        self.writer = csv.DictWriter(self.handle,fieldnames=self.fieldnames,extrasaction="ignore")
+
+    def writerow(self,row):
+        if self.handle is None or (self.chunk_size and self.num_rows % self.chunk_size == 0):
+            self.new_file()
+        self.writer.writerow(row)
+        self.num_rows += 1
+
+    def close(self):
+        if self.handle is None:
+            self.new_file()
+        self.handle.close()
+
+
+def write_csv(filename,rows,fieldnames,header=None,extra=None):
+    # Write a list of dicts. The extra dict holds constant columns (e.g. the
+    # :LABEL or :TYPE of neo4j-admin files)
+    extra = extra if extra else {}
+    with open(filename,"w") as O:
+        csv.writer(O).writerow((header if header else fieldnames) + list(extra))
+        writer = csv.DictWriter(O,fieldnames = fieldnames + list(extra),extrasaction="ignore")
+        for row in rows:
+            writer.writerow(dict(row,**extra))
+
+
+def get_sample_records(data):
+    # Runs in the loader workers so only the fields used are sent back
+    sample_node = {
+        "drtype":data["drtype"],
+        "lineage":data["sublin"],
+        "lineageInfo": json.dumps(data["lineage"]),
+        "qc": json.dumps({"pct_reads_mapped":data["qc"]["pct_reads_mapped"],"pct_reads_mapped":data["qc"]["pct_reads_mapped"],"gene_coverage":[]}),
+        "pipeline": json.dumps(data["pipeline"]),
+        "tbprofilerVersion": json.dumps(data["tbprofiler_version"]),
+        "dbVersion": json.dumps(data["db_version"]),
+    }
+    variants = []
+    for var in data["dr_variants"] + data["other_variants"]:
+        # if var["type"]=="synonymous": continue
+        variants.append({
+            "id": "%s_%s" % (var["locus_tag"],var["change"]),
+            "type": var["type"].replace("*",""),
+            "change": var["change"],
+            "gene": var["gene"],
+            "locus_tag": var["locus_tag"],
+            "freq": var["freq"],
+            "genome_pos": var["genome_pos"],
+            "nucleotideChange": var.get("nucleotide_change","NA"),
+            "internalChange": var.get("_internal_change","NA"),
+            "drugs": [d["drug"] for d in var.get("drugs",[])],
+        })
+    return data["sublin"],sample_node,variants
+
 
 def main(args):
-    conf = get_conf_dict(sys.base_prefix + "/share/tbprofiler/%s" % args.db)
-    locus_tag2drugs = tbprofiler.get_lt2drugs(conf["bed"])
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
-    else:
-        samples = [x.replace(args.suffix,"") for x in os.listdir(args.dir) if x[-len(args.suffix):]==args.suffix]
+    db = Database(args.db)
+    locus_tag2drugs = db.locus_tag2drugs
+    samples = get_samples(args.samples,args.dir,args.suffix)
+    admin = args.format=="admin"
 
     if args.meta:
         meta = {}
@@ -57,11 +132,12 @@ def main(args):
 
 
     sample_nodes = []
-    tmp_variant_nodes = []
-    sample_variant_edges = []
+    # Nodes and edges are deduplicated as the samples are processed so the
+    # memory used depends on the number of distinct variants
+    variant_nodes = {}
     drugs = set()
     lineage_nodes = set()
-    tmp_variant_drug_edges = []
+    variant_drug_edges = {}
     sample_lineage_edges = []
     spoligotype_nodes = set()
     sample_spoligotype_edges = []
@@ -72,22 +148,20 @@ def main(args):
             sample_spoligotype_edges.append({"id":row["sample"],"spoligotype":row["spoligotype"]})
             spoligotype_nodes.add(row["spoligotype"])
 
+    # The sample-variant edges are written to disk as the samples are processed
+    if admin:
+        sample_variant_edges = ChunkedCSVWriter(
+            "sample_variant_edges",SAMPLE_VARIANT_EDGE_FIELDS + [":TYPE"],
+            header=[ADMIN_HEADERS.get(f,f) for f in SAMPLE_VARIANT_EDGE_FIELDS] + [":TYPE"]
+        )
+    else:
+        sample_variant_edges = ChunkedCSVWriter("sample_variant_edges",SAMPLE_VARIANT_EDGE_FIELDS,chunk_size=args.chunk_size)
+
     # Loop through the sample result files
-    for s in tqdm(samples):
-        # Data has the same structure as the .result.json files
-        data = json.load(open(pp.filecheck("%s/%s%s" % (args.dir,s,args.suffix))))
-        sample_node = {
-            "id":s,
-            "drtype":data["drtype"],
-            "lineage":data["sublin"],
-            "lineageInfo": json.dumps(data["lineage"]),
-            "qc": json.dumps({"pct_reads_mapped":data["qc"]["pct_reads_mapped"],"pct_reads_mapped":data["qc"]["pct_reads_mapped"],"gene_coverage":[]}),
-            "pipeline": json.dumps(data["pipeline"]),
-            "tbprofilerVersion": json.dumps(data["tbprofiler_version"]),
-            "dbVersion": json.dumps(data["db_version"]),
-        }
-        lineage_nodes.add(data["sublin"])
-        sample_lineage_edges.append({"sampleId":s,"lineage":data["sublin"]})
+    for s,(lineage,sample_node,variants) in load_results(samples,args.dir,args.suffix,extract=get_sample_records,workers=args.workers):
+        sample_node = dict(id=s,**sample_node)
+        lineage_nodes.add(lineage)
+        sample_lineage_edges.append({"sampleId":s,"lineage":lineage})
         if args.meta:
             for c in list(meta.values())[0]:
                 if c=="id": continue
@@ -98,96 +172,83 @@ def main(args):
             sample_node["spoligotype"] = spoligotypes.get(s,"NA")
 
         sample_nodes.append(sample_node)
-        for var in data["dr_variants"] + data["other_variants"]:
-            # if var["type"]=="synonymous": continue
-            variant_id = "%s_%s" % (var["locus_tag"],var["change"])
-            sample_variant_edges.append(
-                {
-                    "sampleId":s,
-                    "variantId":variant_id,
-                    "freq":var["freq"],
-                    "genome_pos": var["genome_pos"],
-                    "nucleotideChange": var.get("nucleotide_change","NA"),
-                    "internalChange": var.get("_internal_change","NA")
-                }
-            )
-            tmp_variant_nodes.append(
-                {
-                    "id": variant_id,
-                    "type": var["type"].replace("*",""),
-                    "change": var["change"],
-                    "gene": var["gene"],
-                    "locus_tag": var["locus_tag"],
-                }
-            )
-            if "drugs" in var:
-                for d in var["drugs"]:
-                    drugs.add(d["drug"])
-                    tmp_variant_drug_edges.append(
-                        {
-                            "variantId": variant_id,
-                            "drug": d["drug"]
-                        }
-                    )
+        for var in variants:
+            edge = dict(var,sampleId=s,variantId=var["id"])
+            if admin:
+                edge[":TYPE"] = "CONTAINS"
+            sample_variant_edges.writerow(edge)
+            add_variant_node(variant_nodes,{k:var[k] for k in ["id","type","change","gene","locus_tag"]})
+            for d in var["drugs"]:
+                drugs.add(d)
+                variant_drug_edges[(var["id"],d)] = None
+    sample_variant_edges.close()
 
 
     drug_nodes = [{"id":d} for d in drugs]
     lineage_nodes = [{"id":d} for d in lineage_nodes]
     spoligotype_nodes = [{"id":d} for d in spoligotype_nodes]
-    variant_drug_edges = uniq_dict_list(tmp_variant_drug_edges)
-    variant_nodes = uniq_dict_list(standardise_types(tmp_variant_nodes))
-
-    def batch(iterable, n=1):
-        l = len(iterable)
-        for ndx in range(0, l, n):
-            yield iterable[ndx:min(ndx + n, l)]
-
-    with open("sample_nodes.csv","w") as O:
-        writer = csv.DictWriter(O,fieldnames = list(sample_nodes[0]))
-        writer.writeheader()
-        writer.writerows(sample_nodes)
-
-    with open("variant_nodes.csv","w") as O:
-        writer = csv.DictWriter(O,fieldnames = list(variant_nodes[0]))
-        writer.writeheader()
-        writer.writerows(variant_nodes)
-
-    for i,x in enumerate(batch(list(range(len(sample_variant_edges))),10000)):
-        with open("sample_variant_edges.%s.csv" % i,"w") as O:
-            writer = csv.DictWriter(O,fieldnames = list(sample_variant_edges[0]))
-            writer.writeheader()
-            for j in x:
-                writer.writerow(sample_variant_edges[j])
-
-    with open("drug_nodes.csv","w") as O:
-        writer = csv.DictWriter(O,fieldnames = list(drug_nodes[0]))
-        writer.writeheader()
-        writer.writerows(drug_nodes)
-
-    with open("variant_drug_edges.csv","w") as O:
-        writer = csv.DictWriter(O,fieldnames = list(variant_drug_edges[0]))
-        writer.writeheader()
-        writer.writerows(variant_drug_edges)
-
-    with open("lineage_nodes.csv","w") as O:
-        writer = csv.DictWriter(O,fieldnames = list(lineage_nodes[0]))
-        writer.writeheader()
-        writer.writerows(lineage_nodes)
-
-    with open("sample_lineage_edges.csv","w") as O:
-        writer = csv.DictWriter(O,fieldnames = list(sample_lineage_edges[0]))
-        writer.writeheader()
-        writer.writerows(sample_lineage_edges)
-
-    with open("spoligotype_nodes.csv","w") as O:
-        writer = csv.DictWriter(O,fieldnames = list(spoligotype_nodes[0]))
-        writer.writeheader()
-        writer.writerows(spoligotype_nodes)
-
-    with open("sample_spoligotype_edges.csv","w") as O:
-        writer = csv.DictWriter(O,fieldnames = list(sample_spoligotype_edges[0]))
-        writer.writeheader()
-        writer.writerows(sample_spoligotype_edges)
+    variant_drug_edges = [{"variantId":v,"drug":d} for v,d in variant_drug_edges]
+    variant_nodes = list(iter_variant_nodes(variant_nodes))
+
+    if admin:
+        write_admin_files(args,sample_nodes,variant_nodes,drug_nodes,lineage_nodes,spoligotype_nodes,variant_drug_edges,sample_lineage_edges,sample_spoligotype_edges,sample_variant_edges)
+    else:
+        write_load_csv_files(args,sample_nodes,variant_nodes,drug_nodes,lineage_nodes,spoligotype_nodes,variant_drug_edges,sample_lineage_edges,sample_spoligotype_edges,sample_variant_edges)
+
+
+def write_admin_files(args,sample_nodes,variant_nodes,drug_nodes,lineage_nodes,spoligotype_nodes,variant_drug_edges,sample_lineage_edges,sample_spoligotype_edges,sample_variant_edges):
+    # Files in the neo4j-admin database import format. The import aborts on
+    # duplicate node IDs and on relationships to missing nodes, so a variant
+    # called with several types is written once (with its first type) and
+    # only the spoligotypes of the loaded samples are linked.
+    loaded_samples = {n["id"] for n in sample_nodes}
+    sample_spoligotype_edges = [e for e in sample_spoligotype_edges if e["id"] in loaded_samples]
+    unique_variant_nodes = {}
+    for v in variant_nodes:
+        unique_variant_nodes.setdefault(v["id"],v)
+    variant_nodes = list(unique_variant_nodes.values())
+
+    sample_fields = list(sample_nodes[0])
+    write_csv("sample_nodes.csv",sample_nodes,sample_fields,header=["id:ID(Sample)"]+sample_fields[1:],extra={":LABEL":"Sample;SRA"})
+    write_csv("variant_nodes.csv",variant_nodes,["id","type","change","gene","locus_tag"],header=["id:ID(Variant)","type","change","gene","locus_tag"],extra={":LABEL":"Variant"})
+    write_csv("drug_nodes.csv",drug_nodes,["id"],header=["id:ID(Drug)"],extra={":LABEL":"Drug"})
+    write_csv("lineage_nodes.csv",lineage_nodes,["id"],header=["id:ID(Lineage)"],extra={":LABEL":"Lineage"})
+    write_csv("spoligotype_nodes.csv",spoligotype_nodes,["id"],header=["id:ID(Spoligotype)"],extra={":LABEL":"Spoligotype"})
+
+    genes = {v["locus_tag"]:v["gene"] for v in variant_nodes}
+    gene_nodes = [{"id":locus_tag,"locusTag":locus_tag,"name":gene} for locus_tag,gene in genes.items()]
+    write_csv("gene_nodes.csv",gene_nodes,["id","locusTag","name"],header=["id:ID(Gene)","locusTag","name"],extra={":LABEL":"Gene"})
+    write_csv("variant_gene_edges.csv",variant_nodes,["id","locus_tag"],header=[":START_ID(Variant)",":END_ID(Gene)"],extra={":TYPE":"IN_GENE"})
+    write_csv("variant_drug_edges.csv",variant_drug_edges,["variantId","drug"],header=[":START_ID(Variant)",":END_ID(Drug)"],extra={":TYPE":"CONFERS_RESISTANCE"})
+    write_csv("sample_lineage_edges.csv",sample_lineage_edges,["sampleId","lineage"],header=[":START_ID(Sample)",":END_ID(Lineage)"],extra={":TYPE":"LINEAGE"})
+    write_csv("sample_spoligotype_edges.csv",sample_spoligotype_edges,["id","spoligotype"],header=[":START_ID(Sample)",":END_ID(Spoligotype)"],extra={":TYPE":"SPOLIGOTYPE"})
+
+    node_files = ["sample_nodes.csv","variant_nodes.csv","drug_nodes.csv","lineage_nodes.csv","spoligotype_nodes.csv","gene_nodes.csv"]
+    relationship_files = sample_variant_edges.files + ["variant_gene_edges.csv","variant_drug_edges.csv","sample_lineage_edges.csv","sample_spoligotype_edges.csv"]
+    if "countryCode" in sample_fields:
+        countries = [{"id":c} for c in sorted({n["countryCode"] for n in sample_nodes if n["countryCode"]})]
+        write_csv("country_nodes.csv",countries,["id"],header=["id:ID(Country)"],extra={":LABEL":"Country"})
+        write_csv("sample_country_edges.csv",[n for n in sample_nodes if n["countryCode"]],["id","countryCode"],header=[":START_ID(Sample)",":END_ID(Country)"],extra={":TYPE":"COLLECTED_IN"})
+        node_files.append("country_nodes.csv")
+        relationship_files.append("sample_country_edges.csv")
+
+    with open("neo4j_admin_import.sh","w") as O:
+        O.write("neo4j-admin database import full %s %s %s\n" % (
+            " ".join(["--nodes=%s" % f for f in node_files]),
+            " ".join(["--relationships=%s" % f for f in relationship_files]),
+            args.database
+        ))
+
+
+def write_load_csv_files(args,sample_nodes,variant_nodes,drug_nodes,lineage_nodes,spoligotype_nodes,variant_drug_edges,sample_lineage_edges,sample_spoligotype_edges,sample_variant_edges):
+    write_csv("sample_nodes.csv",sample_nodes,list(sample_nodes[0]))
+    write_csv("variant_nodes.csv",variant_nodes,list(variant_nodes[0]))
+    write_csv("drug_nodes.csv",drug_nodes,list(drug_nodes[0]))
+    write_csv("variant_drug_edges.csv",variant_drug_edges,list(variant_drug_edges[0]))
+    write_csv("lineage_nodes.csv",lineage_nodes,list(lineage_nodes[0]))
+    write_csv("sample_lineage_edges.csv",sample_lineage_edges,list(sample_lineage_edges[0]))
+    write_csv("spoligotype_nodes.csv",spoligotype_nodes,list(spoligotype_nodes[0]))
+    write_csv("sample_spoligotype_edges.csv",sample_spoligotype_edges,list(sample_spoligotype_edges[0]))
 
     with open("Cypher_commands.txt" ,"w") as O:
         if args.index:
@@ -232,10 +293,10 @@ def main(args):
         O.write("CREATE (:Lineage {%s});\n" % ", ".join(["%s: csvLine.%s" % (d,d) for d in lineage_nodes[0]]))
         O.write("\n")
 
-        for i,x in enumerate(batch(list(range(len(sample_variant_edges))),10000)):
-            O.write("LOAD CSV WITH HEADERS FROM 'file:///sample_variant_edges.%s.csv' AS csvLine\n" % i)
+        for filename in sample_variant_edges.files:
+            O.write("LOAD CSV WITH HEADERS FROM 'file:///%s' AS csvLine\n" % filename)
             O.write("MATCH (s:Sample {id: csvLine.sampleId}),(v:Variant {id:csvLine.variantId})\n")
-            O.write("CREATE (s) -[:CONTAINS {%s}]-> (v);\n" % ", ".join(["%s: csvLine.%s" % (d,d) for d in sample_variant_edges[0]]))
+            O.write("CREATE (s) -[:CONTAINS {%s}]-> (v);\n" % ", ".join(["%s: csvLine.%s" % (d,d) for d in SAMPLE_VARIANT_EDGE_FIELDS]))
             O.write("\n")
 
         O.write("LOAD CSV WITH HEADERS FROM 'file:///variant_drug_edges.csv' AS csvLine\n")
@@ -270,7 +331,11 @@ parser.add_argument('--suffix',default=".results.json",type=str,help='File suffi
 parser.add_argument('--meta',type=str,help='Meta file')
 parser.add_argument('--spoligotypes',type=str,help='Meta file',required=True)
 parser.add_argument('--index',action="store_true",help='Write index commands')
+parser.add_argument('--format',default="cypher",choices=["cypher","admin"],type=str,help='Write CSV files and LOAD CSV commands (cypher) or files for an offline neo4j-admin database import (admin)')
+parser.add_argument('--database',default="neo4j",type=str,help='Database name used in the neo4j-admin import command')
+parser.add_argument('--chunk-size',default=10000,type=int,help='Number of sample-variant edges per file in cypher mode')
 
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
@@ -3,38 +3,35 @@ import json
 from collections import defaultdict
 import argparse
 import os
-from tqdm import tqdm
 import sys
 import csv
-import pathogenprofiler as pp
-
-
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
+from tbprofiler_utils import get_samples, load_results, add_loader_args, read_variant_store, Database
 
 
 def main(args):
-    conf = get_conf_dict(sys.base_prefix + "/share/tbprofiler/%s" % args.db)
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
-    else:
-        samples = [x.replace(args.suffix,"") for x in os.listdir(args.dir) if x[-len(args.suffix):]==args.suffix]
+    db = Database(args.db)
 
 
     mutations = defaultdict(list)
     mutation2drugs = defaultdict(set)
 
-    for s in tqdm(samples):
-        data = json.load(open(pp.filecheck("%s/%s%s" % (args.dir,s,args.suffix))))
-        for var in data["dr_variants"]:
-            mutations[(var["gene"],var["change"])].append(s)
-            for d in var["drugs"]:
-                mutation2drugs[(var["gene"],var["change"])].add(d["drug"])
+    if args.store:
+        # Read the variants from the store built with tbprofiler_index.py instead of the json files
+        columns = ["sample_id","gene","change","drugs","dr_variant"]
+        store_samples,table = read_variant_store(args.store,columns=columns)
+        sample_set = set(get_samples(args.samples,args.dir,args.suffix) if args.samples else store_samples)
+        for s,gene,change,drugs,dr_variant in zip(*[table.column(c).to_pylist() for c in columns]):
+            if not dr_variant or s not in sample_set: continue
+            mutations[(gene,change)].append(s)
+            for d in drugs.split(","):
+                mutation2drugs[(gene,change)].add(d)
+    else:
+        samples = get_samples(args.samples,args.dir,args.suffix)
+        for s,data in load_results(samples,args.dir,args.suffix,workers=args.workers):
+            for var in data["dr_variants"]:
+                mutations[(var["gene"],var["change"])].append(s)
+                for d in var["drugs"]:
+                    mutation2drugs[(var["gene"],var["change"])].add(d["drug"])
 
 
     results = []
@@ -59,6 +56,8 @@ parser.add_argument('--samples',type=str,help='File with samples')
 parser.add_argument('--dir',default="results/",type=str,help='Directory containing results')
 parser.add_argument('--db',default="tbdb",type=str,help='Database name')
 parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+parser.add_argument('--store',type=str,help='Variant store created with tbprofiler_index.py (used instead of the result files)')
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()
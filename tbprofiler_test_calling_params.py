@@ -4,8 +4,11 @@ import pathogenprofiler as pp
 import argparse
 import json
 import tbprofiler as tbp
+from tbprofiler_utils import get_conf_dict, get_mp_context, StageTimer
 import os
 import csv
+import copy
+import itertools
 
 
 try:
@@ -13,16 +16,7 @@ try:
 except:
     sys.base_prefix = getattr(sys, 'base_prefix', getattr(sys, 'real_prefix', sys.prefix))
 
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
-
-
-def main_profile(args):
+def get_conf(args):
     #### Setup conf dictionary ###
     if args.db=="tbdb" and not args.external_db and pp.nofile(sys.base_prefix+"/share/tbprofiler/tbdb.fasta"):
         pp.log("Can't find the tbdb file at %s. Please run 'tb-profiler update_tbdb' to load the default library or specify another using the '--external_db' flag" % sys.base_prefix,ext=True)
@@ -44,51 +38,62 @@ def main_profile(args):
         args.mapper = "minimap2"
         args.caller = "bcftools"
         args.no_trim=True
-        run_delly = False
-    else:
-        if args.no_delly:
-            run_delly = False
-        else:
-            run_delly = True
+    return conf
 
-    ### Setup prefix for files ###
-    files_prefix = args.dir+"/"+args.prefix
 
-    ### Create bam file if fastq has been supplied ###
-    if args.bam==None:
-        if args.read1 and args.read2 and args.no_trim:
-            # Paired + no trimming
-            fastq_obj = pp.fastq(args.read1,args.read2)
-        elif args.read1 and args.read2 and not args.no_trim:
-            # Paired + trimming
-            untrimmed_fastq_obj = pp.fastq(args.read1,args.read2)
+def map_reads(args,conf,files_prefix,timer):
+    ### Create bam file from the fastq file(s) ###
+    if args.read1 and args.read2 and args.no_trim:
+        # Paired + no trimming
+        fastq_obj = pp.fastq(args.read1,args.read2)
+    elif args.read1 and args.read2 and not args.no_trim:
+        # Paired + trimming
+        untrimmed_fastq_obj = pp.fastq(args.read1,args.read2)
+        with timer.stage("trim"):
             fastq_obj = untrimmed_fastq_obj.trim(files_prefix,threads=args.threads)
-        elif args.read1 and not args.read2 and args.no_trim:
-            # Unpaired + trimming
-            fastq_obj = pp.fastq(args.read1,args.read2)
-        elif args.read1 and not args.read2 and not args.no_trim:
-            # Unpaired + trimming
-            untrimmed_fastq_obj = pp.fastq(args.read1)
+    elif args.read1 and not args.read2 and args.no_trim:
+        # Unpaired + trimming
+        fastq_obj = pp.fastq(args.read1,args.read2)
+    elif args.read1 and not args.read2 and not args.no_trim:
+        # Unpaired + trimming
+        untrimmed_fastq_obj = pp.fastq(args.read1)
+        with timer.stage("trim"):
             fastq_obj = untrimmed_fastq_obj.trim(files_prefix,threads=args.threads)
-        else:
-            exit("\nPlease provide a bam file or a fastq file(s)...Exiting!\n")
+    else:
+        exit("\nPlease provide a bam file or a fastq file(s)...Exiting!\n")
+    with timer.stage("map"):
         bam_obj = fastq_obj.map_to_ref(
             ref_file=conf["ref"], prefix=files_prefix,sample_name=args.prefix,
             aligner=args.mapper, platform=args.platform, threads=args.threads
         )
-        bam_file = bam_obj.bam_file
+    return bam_obj.bam_file,fastq_obj
+
+
+def main_profile(args):
+    timer = StageTimer(sample=args.prefix,trace_file=args.trace)
+    conf = get_conf(args)
+    run_delly = False if args.platform=="nanopore" or args.no_delly else True
+
+    ### Setup prefix for files ###
+    files_prefix = args.dir+"/"+args.prefix
+
+    ### Create bam file if fastq has been supplied ###
+    if args.bam==None:
+        bam_file,fastq_obj = map_reads(args,conf,files_prefix,timer)
     else:
         bam_file = args.bam
 
     ### Run profiling module from pathogen-profiler ###
-    results = pp.bam_profiler(
-        conf=conf, bam_file=bam_file, prefix=files_prefix, platform=args.platform,
-        caller=args.caller, threads=args.threads, no_flagstat=args.no_flagstat,
-        run_delly = run_delly, calling_params=args.calling_params
-    )
+    with timer.stage("call"):
+        results = pp.bam_profiler(
+            conf=conf, bam_file=bam_file, prefix=files_prefix, platform=args.platform,
+            caller=args.caller, threads=args.threads, no_flagstat=args.no_flagstat,
+            run_delly = run_delly, calling_params=args.calling_params
+        )
 
     ### Reformat the results to TB-Profiler style ###
-    results = tbp.reformat(results, conf, reporting_af=args.reporting_af)
+    with timer.stage("reformat"):
+        results = tbp.reformat(results, conf, reporting_af=args.reporting_af)
     results["id"] = args.prefix
     results["tbprofiler_version"] = tbp._VERSION
     results["pipeline"] = {"mapper":args.mapper if not args.bam else "N/A","variant_caller":args.caller}
@@ -98,25 +103,26 @@ def main_profile(args):
     text_output = args.dir+"/results/"+args.prefix+".results.txt"
     csv_output = args.dir+"/results/"+args.prefix+".results.csv"
 
-    json.dump(results,open(json_output,"w"))
-    extra_columns = [x.lower() for x in args.add_columns.split(",")] if args.add_columns else []
-    if args.pdf:
-        tbp.write_tex(results,conf,tex_output,extra_columns)
-        pp.run_cmd("pdflatex %s"%tex_output,verbose=1)
-        pp.rm_files([tex_output, args.dir+"/"+args.prefix+".results.aux",args.dir+"/"+args.prefix+".results.log"])
-    if args.txt:
-        tbp.write_text(results,conf,text_output,extra_columns,reporting_af=args.reporting_af)
-    if args.csv:
-        tbp.write_csv(results,conf,csv_output,extra_columns)
-
-    ### Move files to respective directories ###
-    if not args.bam:
-        pp.run_cmd("mv %(dir)s/%(prefix)s.bam* %(dir)s/bam/" % vars(args))
-        if not args.no_trim:
-            pp.run_cmd("rm -f %s" % " ".join(fastq_obj.files))
-    pp.run_cmd("mv -f %(dir)s/%(prefix)s*.vcf.gz* %(dir)s/vcf/" % vars(args))
-    if run_delly and results["delly"]=="success":
-        pp.run_cmd("mv -f %(dir)s/%(prefix)s.delly.bcf* %(dir)s/vcf/" % vars(args))
+    with timer.stage("output"):
+        extra_columns = [x.lower() for x in args.add_columns.split(",")] if args.add_columns else []
+        if args.pdf:
+            tbp.write_tex(results,conf,tex_output,extra_columns)
+            pp.run_cmd("pdflatex %s"%tex_output,verbose=1)
+            pp.rm_files([tex_output, args.dir+"/"+args.prefix+".results.aux",args.dir+"/"+args.prefix+".results.log"])
+        if args.txt:
+            tbp.write_text(results,conf,text_output,extra_columns,reporting_af=args.reporting_af)
+        if args.csv:
+            tbp.write_csv(results,conf,csv_output,extra_columns)
+
+        ### Move files to respective directories ###
+        if not args.bam:
+            pp.run_cmd("mv %(dir)s/%(prefix)s.bam* %(dir)s/bam/" % vars(args))
+            if not args.no_trim:
+                pp.run_cmd("rm -f %s" % " ".join(fastq_obj.files))
+        # Only match this prefix and not e.g. the files of other runs of a sweep
+        pp.run_cmd("mv -f %(dir)s/%(prefix)s.*vcf.gz* %(dir)s/vcf/" % vars(args))
+        if run_delly and results["delly"]=="success":
+            pp.run_cmd("mv -f %(dir)s/%(prefix)s.delly.bcf* %(dir)s/vcf/" % vars(args))
 
     ### Add meta data to results
     if args.meta:
@@ -124,41 +130,144 @@ def main_profile(args):
             if row["id"]==results["id"]:
                 for col in row:
                     results["meta_"+col] = row[col]
+
+    # The results are written last so that they include the meta data and timings
+    results["pipeline"]["timings"] = timer.timings
+    json.dump(results,open(json_output,"w"))
     pp.log("Profiling finished sucessfully!")
 
 
 
 
+def get_param_sets(args):
+    # Returns a list of (name, calling parameters)
+    param_sets = []
+    if args.params_file:
+        for row in csv.reader(open(args.params_file),delimiter="\t"):
+            if len(row)<2 or row[0].startswith("#"): continue
+            param_sets.append((row[0],row[1]))
+    if args.grid:
+        # e.g. "mq=10,20 bq=13,20" gives the runs mq10_bq13, mq10_bq20 ...
+        keys = []
+        values = []
+        for x in args.grid.split():
+            key,vals = x.split("=")
+            keys.append(key)
+            values.append(vals.split(","))
+        for combination in itertools.product(*values):
+            fields = dict(zip(keys,combination))
+            name = "_".join(["%s%s" % (k,v) for k,v in fields.items()])
+            param_sets.append((name,args.template.format(**fields)))
+    return param_sets
+
+
+def run_sweep_job(args):
+    try:
+        main_profile(args)
+        return args.prefix,"done"
+    except (Exception,SystemExit) as e:
+        # pp.log exits on errors so SystemExit is also caught. KeyboardInterrupt
+        # is not, so Ctrl-C stops the whole run.
+        pp.log("Profiling failed for %s: %s" % (args.prefix,repr(e)))
+        return args.prefix,"failed"
+
+
+def main_sweep(args):
+    import concurrent.futures
+    param_sets = get_param_sets(args)
+    if len(param_sets)==0:
+        pp.log("Please provide calling parameters with --params_file or --grid",ext=True)
+
+    # Map the reads once and call variants with every parameter set from the same bam
+    conf = get_conf(args)
+    if args.bam==None:
+        timer = StageTimer(sample=args.prefix,trace_file=args.trace)
+        bam_file,fastq_obj = map_reads(args,conf,args.dir+"/"+args.prefix,timer)
+        pp.run_cmd("mv %(dir)s/%(prefix)s.bam* %(dir)s/bam/" % vars(args))
+        if not args.no_trim:
+            pp.run_cmd("rm -f %s" % " ".join(fastq_obj.files))
+        bam_file = "%s/bam/%s" % (args.dir,os.path.basename(bam_file))
+        pp.log("Mapping took %.1f seconds" % sum(x["wall"] for x in timer.timings.values()))
+    else:
+        bam_file = args.bam
+
+    jobs = []
+    for name,calling_params in param_sets:
+        job = copy.copy(args)
+        del job.func
+        job.prefix = "%s_%s" % (args.prefix,name)
+        job.bam = bam_file
+        job.calling_params = calling_params
+        jobs.append(job)
+
+    cpus = args.cpus if args.cpus else os.cpu_count()
+    num_workers = max(1,cpus // args.threads)
+    status = {}
+    with concurrent.futures.ProcessPoolExecutor(num_workers,mp_context=get_mp_context()) as executor:
+        for prefix,job_status in executor.map(run_sweep_job,jobs):
+            status[prefix] = job_status
+
+    # Index of the runs used by tbprofiler_evaluate_calling_params.py
+    index_file = args.index if args.index else "%s/%s.sweep_index.tsv" % (args.dir,args.prefix)
+    with open(index_file,"w") as O:
+        writer = csv.writer(O,delimiter="\t")
+        writer.writerow(["sample","run","name","calling_params","status","results_dir"])
+        results_dir = os.path.abspath(args.dir+"/results")
+        for (name,calling_params),job in zip(param_sets,jobs):
+            writer.writerow([args.prefix,job.prefix,name,calling_params,status[job.prefix],results_dir])
+    pp.log("Sweep finished, index written to %s" % index_file)
+
+
+def add_profile_args(parser_sub):
+    # Arguments shared by the profile and sweep subcommands
+    parser_sub.add_argument('--platform','-m',choices=["illumina","nanopore"],default="illumina",help='NGS Platform used to generate data')
+    parser_sub.add_argument('--no_trim',action="store_true",help="Don't trim files using trimmomatic")
+    parser_sub.add_argument('--db',default='tbdb',help='Mutation panel name')
+    parser_sub.add_argument('--external_db',type=str,help='Path to db files prefix (overrides "--db" parameter)')
+    parser_sub.add_argument('--mapper',default="bwa", choices=["bwa","minimap2","bowtie2"],help="Mapping tool to use. If you are using nanopore data it will default to minimap2",type=str)
+    parser_sub.add_argument('--caller',default="bcftools", choices=["bcftools","gatk","freebayes"],help="Variant calling tool to use.",type=str)
+    parser_sub.add_argument('--calling_params',type=str,help='Override default parameters for variant calling')
+    parser_sub.add_argument('--min_depth',default=10,type=int,help='Minimum depth required to call variant. Bases with depth below this cutoff will be marked as missing')
+    parser_sub.add_argument('--af',default=0.1,type=float,help='Minimum allele frequency to call variants')
+    parser_sub.add_argument('--reporting_af',default=0.1,type=float,help='Minimum allele frequency to use variants for prediction')
+    parser_sub.add_argument('--threads','-t',default=1,help='Threads to use',type=int)
+    parser_sub.add_argument('--dir','-d',default=".",help='Storage directory')
+    parser_sub.add_argument('--txt',action="store_true",help="Add text output")
+    parser_sub.add_argument('--csv',action="store_true",help="Add CSV output")
+    parser_sub.add_argument('--pdf',action="store_true",help="Add PDF output. This requires pdflatex to be installed")
+    parser_sub.add_argument('--add_columns',default=None,type=str,help="Add additional columns found in the mutation database to the text and pdf results")
+    parser_sub.add_argument('--meta',default=None,type=str,help="Add meta data from a CSV file to the results. The CSV file must contain a column labelled \"id\" with the same value as the prefix argument")
+    parser_sub.add_argument('--verbose','-v',default=0, choices=[0,1,2],help="Verbosity increases from 0 to 2",type=int)
+    parser_sub.add_argument('--no_flagstat',action="store_true",help="Don't collect flagstats")
+    parser_sub.add_argument('--no_delly',action="store_true",help="Don't run delly")
+    parser_sub.add_argument('--trace',type=str,help='Append the timing and resource usage of each stage to this JSON-lines file')
+
+
 parser = argparse.ArgumentParser(description='TBProfiler pipeline',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 subparsers = parser.add_subparsers(help="Task to perform")
 
 parser_sub = subparsers.add_parser('profile', help='Run whole profiling pipeline', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser_sub.add_argument('--platform','-m',choices=["illumina","nanopore"],default="illumina",help='NGS Platform used to generate data')
 parser_sub.add_argument('--read1','-1',help='First read file')
 parser_sub.add_argument('--read2','-2',help='Second read file')
 parser_sub.add_argument('--bam','-a',help='BAM file. Make sure it has been generated using the H37Rv genome (GCA_000195955.2)')
 parser_sub.add_argument('--prefix','-p',default="tbprofiler",help='Sample prefix for all results generated')
-parser_sub.add_argument('--no_trim',action="store_true",help="Don't trim files using trimmomatic")
-parser_sub.add_argument('--db',default='tbdb',help='Mutation panel name')
-parser_sub.add_argument('--external_db',type=str,help='Path to db files prefix (overrides "--db" parameter)')
-parser_sub.add_argument('--mapper',default="bwa", choices=["bwa","minimap2","bowtie2"],help="Mapping tool to use. If you are using nanopore data it will default to minimap2",type=str)
-parser_sub.add_argument('--caller',default="bcftools", choices=["bcftools","gatk","freebayes"],help="Variant calling tool to use.",type=str)
-parser_sub.add_argument('--calling_params',type=str,help='Override default parameters for variant calling')
-parser_sub.add_argument('--min_depth',default=10,type=int,help='Minimum depth required to call variant. Bases with depth below this cutoff will be marked as missing')
-parser_sub.add_argument('--af',default=0.1,type=float,help='Minimum allele frequency to call variants')
-parser_sub.add_argument('--reporting_af',default=0.1,type=float,help='Minimum allele frequency to use variants for prediction')
-parser_sub.add_argument('--threads','-t',default=1,help='Threads to use',type=int)
-parser_sub.add_argument('--dir','-d',default=".",help='Storage directory')
-parser_sub.add_argument('--txt',action="store_true",help="Add text output")
-parser_sub.add_argument('--csv',action="store_true",help="Add CSV output")
-parser_sub.add_argument('--pdf',action="store_true",help="Add PDF output. This requires pdflatex to be installed")
-parser_sub.add_argument('--add_columns',default=None,type=str,help="Add additional columns found in the mutation database to the text and pdf results")
-parser_sub.add_argument('--meta',default=None,type=str,help="Add meta data from a CSV file to the results. The CSV file must contain a column labelled \"id\" with the same value as the prefix argument")
-parser_sub.add_argument('--verbose','-v',default=0, choices=[0,1,2],help="Verbosity increases from 0 to 2",type=int)
-parser_sub.add_argument('--no_flagstat',action="store_true",help="Don't collect flagstats")
 parser_sub.add_argument('--version', action='version', version="TBProfiler version %s" % tbp._VERSION)
+add_profile_args(parser_sub)
 parser_sub.set_defaults(func=main_profile)
 
+parser_sub = subparsers.add_parser('sweep', help='Map once and run the variant calling with many calling parameter sets', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser_sub.add_argument('--read1','-1',help='First read file')
+parser_sub.add_argument('--read2','-2',help='Second read file')
+parser_sub.add_argument('--bam','-a',help='BAM file. Make sure it has been generated using the H37Rv genome (GCA_000195955.2)')
+parser_sub.add_argument('--prefix','-p',default="tbprofiler",help='Sample prefix. The runs are named <prefix>_<name>')
+parser_sub.add_argument('--params_file',type=str,help='TSV file with a name and calling parameters on each line')
+parser_sub.add_argument('--grid',type=str,help='Grid of values to fill in --template, e.g. "mq=10,20,30 bq=13,20"')
+parser_sub.add_argument('--template',default="-q {mq} -Q {bq}",type=str,help='Calling parameters used with --grid')
+parser_sub.add_argument('--cpus',type=int,help='Total number of CPUs to use. Runs are done in parallel using --threads each (default: all CPUs)')
+parser_sub.add_argument('--index',type=str,help='Output sweep index (default: <dir>/<prefix>.sweep_index.tsv)')
+add_profile_args(parser_sub)
+parser_sub.set_defaults(func=main_sweep)
+
 
 
 args = parser.parse_args()
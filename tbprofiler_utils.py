@@ -0,0 +1,936 @@
+#! /usr/bin/env python
+
+# Shared helpers used by the tbprofiler_*.py scripts to find and load the
+# individual .results.json files.
+#
+# Only light-weight modules are imported at the top of this file. Anything
+# heavier is imported inside the function that needs it, which keeps the
+# start-up time of the scripts (and of tbprofiler_cli.py) low.
+import json
+import os
+import sys
+
+
+def filecheck(filename):
+    # Same behaviour as pathogenprofiler.filecheck without importing pathogenprofiler
+    if not os.path.isfile(filename):
+        sys.stderr.write("\nCan't find %s\n" % filename)
+        quit(1)
+    return filename
+
+
+def get_samples(samples_file,result_dir,suffix):
+    # If a list of samples is supplied store it in a list else get the list from looking in the results directory
+    if samples_file:
+        return [x.rstrip() for x in open(samples_file).readlines()]
+    elif is_archive(result_dir):
+        return list(read_archive_index(result_dir)[1])
+    else:
+        return [entry[0] for entry in get_catalogue(result_dir,suffix)]
+
+
+def get_cache_dir():
+    return os.environ.get("XDG_CACHE_HOME",os.path.expanduser("~/.cache")) + "/tbprofiler_scripts"
+
+
+# Sample catalogue of a results directory. It is stored in the cache directory
+# with one line per result file (sample, path, size, mtime in ns, schema
+# version) and a header with the mtime of the directory. As long as the
+# directory mtime is unchanged no files have been added or removed and the
+# catalogue is used without listing the directory.
+def _catalogue_file(result_dir,suffix):
+    import hashlib
+    key = hashlib.sha1(("%s\t%s" % (os.path.abspath(result_dir),suffix)).encode()).hexdigest()[:16]
+    return "%s/catalogue_%s.tsv" % (get_cache_dir(),key)
+
+
+def read_catalogue(filename):
+    # Returns (directory mtime, [(sample, path, size, mtime, version)]) or (None, [])
+    import mmap
+    entries = []
+    try:
+        with open(filename,"rb") as F, mmap.mmap(F.fileno(),0,access=mmap.ACCESS_READ) as M:
+            # Lines are read straight from the map without copying the whole file
+            header = M.readline().decode()
+            if not header.startswith("#dir_mtime\t"):
+                return None,[]
+            for l in iter(M.readline,b""):
+                sample,path,size,mtime,version = l.decode().rstrip("\n").split("\t")
+                entries.append((sample,path,int(size),int(mtime),version))
+    except (OSError,ValueError):
+        # Missing, empty or written by an older version
+        return None,[]
+    return int(header.split("\t")[1]),entries
+
+
+def write_catalogue(filename,dir_mtime,entries):
+    try:
+        os.makedirs(os.path.dirname(filename),exist_ok=True)
+        tmp = "%s.%s.tmp" % (filename,os.getpid())
+        with open(tmp,"w") as O:
+            O.write("#dir_mtime\t%s\n" % dir_mtime)
+            for entry in entries:
+                O.write("%s\t%s\t%s\t%s\t%s\n" % entry)
+        os.replace(tmp,filename)
+    except OSError:
+        # A read-only cache location just means scanning every time
+        pass
+
+
+def get_catalogue(result_dir,suffix,versions=False,workers=1):
+    """
+    Return a sorted list of (sample, path, size, mtime, version) for the
+    result files in result_dir. The directory is only listed if it has changed
+    since the last call and only new or changed files are looked at. The
+    schema version is "" unless versions is set, in which case the files
+    without a version are parsed (in a process pool if workers>1).
+
+    A file rewritten in place does not change the directory mtime, so without
+    versions the size, mtime and version of the entries can be out of date
+    and only the samples and paths should be relied on. With versions every
+    file is checked and changed files are parsed again.
+    """
+    import time
+    filename = _catalogue_file(result_dir,suffix)
+    dir_mtime = os.stat(result_dir).st_mtime_ns
+    cached_mtime,entries = read_catalogue(filename)
+    if cached_mtime!=dir_mtime or versions:
+        previous = {e[0]:e for e in entries}
+        entries = []
+        for entry in os.scandir(result_dir):
+            if not entry.name.endswith(suffix): continue
+            # Strip the suffix from the end only, so sample names containing it are kept intact
+            sample = entry.name[:-len(suffix)]
+            stat = entry.stat()
+            version = ""
+            if sample in previous and previous[sample][2:4]==(stat.st_size,stat.st_mtime_ns):
+                version = previous[sample][4]
+            entries.append((sample,os.path.abspath(entry.path),stat.st_size,stat.st_mtime_ns,version))
+        entries.sort()
+        if versions:
+            entries = _add_catalogue_versions(entries,workers)
+        # Files added within the mtime resolution of a recent change might not
+        # update the directory mtime, so a very recent directory is rescanned next time
+        if time.time_ns() - dir_mtime < 2*10**9:
+            dir_mtime = 0
+        write_catalogue(filename,dir_mtime,entries)
+    return entries
+
+
+def _catalogue_version_worker(filename):
+    with open(filename,"rb") as F:
+        return detect_schema_version(parse_json(F.read(),["dr_variants","variants"]))
+
+
+def _add_catalogue_versions(entries,workers):
+    from tqdm import tqdm
+    todo = [i for i,e in enumerate(entries) if e[4]==""]
+    files = [entries[i][1] for i in todo]
+    if workers<=1:
+        versions = map(_catalogue_version_worker,files)
+    else:
+        pool = get_mp_context().Pool(workers)
+        versions = pool.imap(_catalogue_version_worker,files,chunksize=max(1,min(64,len(files)//(workers*8))))
+    for i,version in zip(todo,tqdm(versions,total=len(files))):
+        entries[i] = entries[i][:4] + (version,)
+    if workers>1:
+        pool.close()
+        pool.join()
+    return entries
+
+
+# Result archives written by tbprofiler_pack.py. The archive is a single file
+# with the compressed result files appended one after another and a
+# <archive>.idx file with the sample, offset and length of each record. The
+# scripts accept an archive anywhere they accept a results directory.
+def is_archive(path):
+    return os.path.isfile(path)
+
+
+_archive_indexes = {}
+_archive_fds = {}
+_archive_decompressors = {}
+
+
+def read_archive_index(archive):
+    # Returns (codec, {sample: (offset, length)}). Samples added more than once use the last record.
+    stat = os.stat(archive + ".idx")
+    key = os.path.abspath(archive)
+    if key in _archive_indexes and _archive_indexes[key][0]==(stat.st_mtime,stat.st_size):
+        return _archive_indexes[key][1]
+    codec = "zstd"
+    index = {}
+    with open(archive + ".idx") as F:
+        for l in F:
+            row = l.rstrip("\n").split("\t")
+            if row[0]=="#codec":
+                codec = row[1]
+                continue
+            # A pack which was interrupted can leave a partial last line, the
+            # record is added again when the pack is restarted
+            if not l.endswith("\n") or len(row)!=3:
+                continue
+            index[row[0]] = (int(row[1]),int(row[2]))
+    _archive_indexes[key] = ((stat.st_mtime,stat.st_size),(codec,index))
+    return codec,index
+
+
+def get_archive_codec(codec,level=3):
+    # Returns (compress, decompress) functions
+    if codec=="zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compress,zstandard.ZstdDecompressor().decompress
+    elif codec=="zlib":
+        import zlib
+        return (lambda x: zlib.compress(x,level)),zlib.decompress
+    raise ValueError("Unknown archive codec: %s" % codec)
+
+
+def read_archive_record(archive,sample):
+    codec,index = read_archive_index(archive)
+    if sample not in index:
+        sys.stderr.write("\nCan't find %s in %s\n" % (sample,archive))
+        quit(1)
+    offset,length = index[sample]
+    # One file descriptor per process; pread does not share the file position with forked workers
+    key = (os.path.abspath(archive),os.getpid())
+    if key not in _archive_fds:
+        _archive_fds[key] = os.open(archive,os.O_RDONLY)
+    if codec not in _archive_decompressors:
+        _archive_decompressors[codec] = get_archive_codec(codec)[1]
+    return _archive_decompressors[codec](os.pread(_archive_fds[key],length,offset))
+
+
+def _get_json_backend():
+    # The backend can be forced with TBPROFILER_JSON_BACKEND=orjson|simdjson|json,
+    # by default the fastest installed one is used
+    name = os.environ.get("TBPROFILER_JSON_BACKEND","auto")
+    for backend in (["orjson","simdjson","json"] if name=="auto" else [name]):
+        try:
+            if backend=="orjson":
+                import orjson
+                return "orjson",orjson
+            elif backend=="simdjson":
+                import simdjson
+                return "simdjson",simdjson.Parser()
+            elif backend=="json":
+                return "json",json
+        except ImportError:
+            continue
+    raise ValueError("Unknown or unavailable json backend: %s" % name)
+
+json_backend,_json_module = _get_json_backend()
+
+
+def _simdjson_to_python(value):
+    if hasattr(value,"as_dict"):
+        return value.as_dict()
+    if hasattr(value,"as_list"):
+        return value.as_list()
+    return value
+
+
+def parse_json(raw,fields=None):
+    """
+    Parse a json document (bytes). If fields is given only these top-level
+    keys are returned. With simdjson the other keys are never converted to
+    python objects.
+    """
+    try:
+        if json_backend=="simdjson":
+            doc = _json_module.parse(raw)
+            if fields is None:
+                return _simdjson_to_python(doc)
+            data = {}
+            for k in fields:
+                try:
+                    data[k] = _simdjson_to_python(doc[k])
+                except KeyError:
+                    pass
+            return data
+        elif json_backend=="orjson":
+            data = _json_module.loads(raw)
+        else:
+            data = json.loads(raw)
+    except ValueError:
+        # The fast parsers reject NaN/Infinity which the stdlib writes by default
+        data = json.loads(raw)
+    if fields is None:
+        return data
+    return {k:data[k] for k in fields if k in data}
+
+
+def _get_fields(fields):
+    if fields is not None and ("dr_variants" in fields or "other_variants" in fields):
+        # v1 files store all variants under "variants"
+        fields = list(fields) + ["variants"]
+    return fields
+
+
+def load_result(filename,fields=None):
+    # Data has the same structure as the .result.json files. Older schema
+    # versions are presented in the current format (see NormalisedResult).
+    with open(filecheck(filename),"rb") as F:
+        return NormalisedResult(parse_json(F.read(),_get_fields(fields)))
+
+
+def load_archive_result(archive,sample,fields=None):
+    return NormalisedResult(parse_json(read_archive_record(archive,sample),_get_fields(fields)))
+
+
+def _load_worker(task):
+    source,extract,fields = task
+    # source is a file name or an (archive, sample) tuple
+    data = load_archive_result(*source,fields=fields) if isinstance(source,tuple) else load_result(source,fields)
+    # Run the extraction inside the worker so that only the (small) extracted
+    # record needs to be pickled back to the parent process
+    return extract(data) if extract else data
+
+
+def get_mp_context():
+    # Fork where possible so the scripts do not need a __main__ guard
+    import multiprocessing as mp
+    return mp.get_context("fork") if "fork" in mp.get_all_start_methods() else mp.get_context()
+
+
+def load_results(samples,result_dir,suffix,extract=None,workers=1,fields=None):
+    """
+    Yield (sample, data) tuples in the same order as samples.
+
+    If fields is given only these top-level keys are loaded (see parse_json).
+    If extract is given it is called on each result dict and its return value
+    is yielded instead. With workers>1 the files are parsed in a process pool;
+    in that case extract must be a module level function (or a
+    functools.partial of one) so that it can be sent to the workers.
+    """
+    from tqdm import tqdm
+    if is_archive(result_dir):
+        tasks = [((result_dir,s),extract,fields) for s in samples]
+    else:
+        tasks = [("%s/%s%s" % (result_dir,s,suffix),extract,fields) for s in samples]
+    if workers<=1:
+        for s,task in zip(samples,tqdm(tasks)):
+            yield s,_load_worker(task)
+        return
+
+    ctx = get_mp_context()
+    chunksize = max(1,min(64,len(tasks)//(workers*8)))
+    with ctx.Pool(workers) as pool:
+        # imap keeps the input order so the output of the scripts is deterministic
+        for s,data in zip(samples,tqdm(pool.imap(_load_worker,tasks,chunksize=chunksize),total=len(tasks))):
+            yield s,data
+
+
+def add_loader_args(parser):
+    parser.add_argument('--workers',default=1,type=int,help='Number of processes used to load the result files')
+
+
+def get_conf_dict(library_prefix):
+    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
+    conf = {}
+    for key in files:
+        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
+        conf[key] = filecheck(library_prefix+files[key])
+    return conf
+
+
+def parse_bed(bed_file):
+    # Columns are: chrom, start, end, locus_tag, gene, comma separated drugs
+    locus_tag2drugs = {}
+    locus_tag2gene = {}
+    for l in open(bed_file):
+        row = l.strip().split()
+        if len(row)<6: continue
+        locus_tag2drugs[row[3]] = [] if row[5]=="None" else row[5].split(",")
+        locus_tag2gene[row[3]] = row[4]
+    return {"locus_tag2drugs":locus_tag2drugs,"locus_tag2gene":locus_tag2gene}
+
+
+def parse_gff_genes(gff_file):
+    # Returns {locus_tag: {"chrom","start","end","strand","name"}}
+    genes = {}
+    for l in open(gff_file):
+        if l[0]=="#": continue
+        row = l.strip().split("\t")
+        if len(row)<9 or row[2]!="gene": continue
+        attributes = dict(a.split("=",1) for a in row[8].split(";") if "=" in a)
+        locus_tag = attributes.get("locus_tag",attributes.get("ID","").replace("gene:",""))
+        genes[locus_tag] = {
+            "chrom": row[0], "start": int(row[3]), "end": int(row[4]), "strand": row[6],
+            "name": attributes.get("Name",locus_tag)
+        }
+    return genes
+
+
+class Database:
+    """
+    Parsed view of a TB-Profiler database (bed, gff and version files).
+
+    Every section is only parsed when it is first used and the parsed data is
+    cached on disk (in $XDG_CACHE_HOME/tbprofiler_scripts or ~/.cache/tbprofiler_scripts).
+    The cache is keyed by the path, mtime and size of the database files so
+    it is rebuilt whenever the database is updated.
+    """
+    sections = {"bed":("bed",parse_bed),"genes":("gff",parse_gff_genes),"version":("version",lambda f: json.load(open(f)))}
+
+    def __init__(self,db="tbdb",external_db=None):
+        self.prefix = external_db if external_db else sys.base_prefix + "/share/tbprofiler/%s" % db
+        self.conf = get_conf_dict(self.prefix)
+        self.cache_file = "%s/%s.json" % (get_cache_dir(),os.path.abspath(self.prefix).strip("/").replace("/","_"))
+        self._cache = None
+
+    def _file_key(self,key):
+        st = os.stat(self.conf[key])
+        return [os.path.abspath(self.conf[key]),st.st_mtime,st.st_size]
+
+    def _get(self,section):
+        if self._cache is None:
+            try:
+                self._cache = json.load(open(self.cache_file))
+            except (OSError,ValueError):
+                self._cache = {}
+        conf_key,parser = self.sections[section]
+        file_key = self._file_key(conf_key)
+        if section not in self._cache or self._cache[section]["key"]!=file_key:
+            self._cache[section] = {"key":file_key,"data":parser(self.conf[conf_key])}
+            try:
+                os.makedirs(os.path.dirname(self.cache_file),exist_ok=True)
+                tmp = "%s.%s.tmp" % (self.cache_file,os.getpid())
+                with open(tmp,"w") as O:
+                    json.dump(self._cache,O)
+                    O.flush()
+                    os.fsync(O.fileno())
+                os.replace(tmp,self.cache_file)
+            except OSError:
+                # A read-only cache location just means parsing every time
+                pass
+        return self._cache[section]["data"]
+
+    @property
+    def locus_tag2drugs(self):
+        # {"Rv1484": ["isoniazid","ethionamide"], ... etc. }
+        return self._get("bed")["locus_tag2drugs"]
+
+    @property
+    def locus_tag2gene(self):
+        return self._get("bed")["locus_tag2gene"]
+
+    @property
+    def gene2locus_tag(self):
+        return {g:lt for lt,g in self.locus_tag2gene.items()}
+
+    @property
+    def gene2drugs(self):
+        return {self.locus_tag2gene[lt]:drugs for lt,drugs in self.locus_tag2drugs.items()}
+
+    @property
+    def drug2locus_tags(self):
+        drug2locus_tags = {}
+        for lt,drugs in self.locus_tag2drugs.items():
+            for drug in drugs:
+                drug2locus_tags.setdefault(drug,[]).append(lt)
+        return drug2locus_tags
+
+    @property
+    def drug2genes(self):
+        # {"rifampicin": ["rpoB", "rpoC"], "clofazimine": ["mmpR5", "pepQ"], ... etc. }
+        return {drug:[self.locus_tag2gene[lt] for lt in lts] for drug,lts in self.drug2locus_tags.items()}
+
+    @property
+    def drugs(self):
+        return sorted(self.drug2locus_tags)
+
+    @property
+    def genes(self):
+        # Gene coordinates from the gff: {"Rv0667": {"chrom":"Chromosome","start":759807,"end":763325,"strand":"+","name":"rpoB"}, ...}
+        return self._get("genes")
+
+    def get_gene(self,gene):
+        # Look up a gene by locus_tag or name
+        genes = self.genes
+        if gene in genes:
+            return genes[gene]
+        for g in genes.values():
+            if g["name"]==gene:
+                return g
+        return None
+
+    @property
+    def version(self):
+        return self._get("version")
+
+
+class StageTimer:
+    """
+    Records the wall time, CPU time and memory high-water mark of each stage
+    of the profiling pipeline. CPU time includes the external commands run
+    during the stage. Each stage is also appended as a line to trace_file if
+    given.
+
+    cumulative_max_rss_mb is not a per-stage peak. getrusage only reports the
+    largest RSS of the process and of any finished child over the lifetime of
+    the process, so it is the peak reached so far: every stage after the
+    heaviest one reports that stage's peak, and in a reused batch worker it
+    includes the samples run before.
+    """
+    def __init__(self,sample=None,trace_file=None):
+        self.sample = sample
+        self.trace_file = trace_file
+        self.timings = {}
+
+    def stage(self,name):
+        import contextlib
+        import time
+        import resource
+
+        # ru_maxrss is in KB on Linux and in bytes on macOS
+        rss_scale = 1024*1024 if sys.platform=="darwin" else 1024
+
+        @contextlib.contextmanager
+        def timed_stage():
+            start_time = time.time()
+            start = time.perf_counter()
+            self_start = resource.getrusage(resource.RUSAGE_SELF)
+            children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+            try:
+                yield
+            finally:
+                self_end = resource.getrusage(resource.RUSAGE_SELF)
+                children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+                record = {
+                    "wall": time.perf_counter() - start,
+                    "cpu_user": (self_end.ru_utime - self_start.ru_utime) + (children_end.ru_utime - children_start.ru_utime),
+                    "cpu_system": (self_end.ru_stime - self_start.ru_stime) + (children_end.ru_stime - children_start.ru_stime),
+                    "children_cpu": (children_end.ru_utime - children_start.ru_utime) + (children_end.ru_stime - children_start.ru_stime),
+                    # Lifetime high-water mark, see the class docstring
+                    "cumulative_max_rss_mb": max(self_end.ru_maxrss,children_end.ru_maxrss)/rss_scale,
+                }
+                self.add(name,record,start_time)
+
+        return timed_stage()
+
+    def add(self,name,record,start_time):
+        if name in self.timings:
+            # Stages run more than once are summed
+            previous = self.timings[name]
+            for key in ["wall","cpu_user","cpu_system","children_cpu"]:
+                record[key] += previous[key]
+            record["cumulative_max_rss_mb"] = max(record["cumulative_max_rss_mb"],previous["cumulative_max_rss_mb"])
+        self.timings[name] = record
+        if self.trace_file:
+            with open(self.trace_file,"a") as O:
+                O.write(json.dumps(dict(sample=self.sample,stage=name,start=start_time,**record)) + "\n")
+
+
+def test_2x2_tables(both,total1,total2,n):
+    """
+    Vectorised version of statsmodels Table2x2 for many tables at once.
+
+    Takes arrays with the number of samples with both mutations, with each
+    mutation and the total number of samples. Returns arrays with the odds
+    ratio (0.5 added to all cells of tables containing a zero), its Wald
+    p-value and the Pearson chi-square p-value. As in statsmodels both tests
+    use the shifted table.
+    """
+    import numpy as np
+    from scipy import stats
+    a = np.asarray(both,dtype=float)
+    b = total1 - a
+    c = total2 - a
+    d = n - a - b - c
+    shift = np.where((a==0) | (b==0) | (c==0) | (d==0),0.5,0.0)
+    sa,sb,sc,sd = a+shift,b+shift,c+shift,d+shift
+    log_or = np.log(sa) + np.log(sd) - np.log(sb) - np.log(sc)
+    log_or_se = np.sqrt(1/sa + 1/sb + 1/sc + 1/sd)
+    or_pval = 2*stats.norm.sf(np.abs(log_or)/log_or_se)
+    sn = sa + sb + sc + sd
+    chi2 = sn*(sa*sd - sb*sc)**2 / ((sa+sb)*(sc+sd)*(sa+sc)*(sb+sd))
+    pval = stats.chi2.sf(chi2,1)
+    return np.exp(log_or),or_pval,pval
+
+
+# Columns of the variant store written by tbprofiler_index.py. There is one
+# row per (sample, variant) and the sample-level fields are repeated per row.
+VARIANT_STORE_COLUMNS = [
+    ("sample_id","string"),("genome_pos","int64"),("gene","string"),("locus_tag","string"),
+    ("change","string"),("type","string"),("freq","float64"),("drugs","string"),("dr_variant","bool_"),
+    ("main_lin","string"),("sublin","string"),("drtype","string"),
+    ("pct_reads_mapped","float64"),("num_reads_mapped","int64"),("median_coverage","float64"),
+]
+
+
+def get_variant_rows(data):
+    rows = []
+    qc = data.get("qc",{})
+    for dr,pool in [(True,data["dr_variants"]),(False,data["other_variants"])]:
+        for var in pool:
+            rows.append({
+                "genome_pos": int(var["genome_pos"]),
+                "gene": var["gene"],
+                "locus_tag": var["locus_tag"],
+                "change": var["change"],
+                "type": var["type"],
+                "freq": float(var["freq"]),
+                "drugs": ",".join([d["drug"] for d in var["drugs"]]) if "drugs" in var else "",
+                "dr_variant": dr,
+                "main_lin": data["main_lin"],
+                "sublin": data["sublin"],
+                "drtype": data["drtype"],
+                "pct_reads_mapped": qc.get("pct_reads_mapped"),
+                "num_reads_mapped": qc.get("num_reads_mapped"),
+                "median_coverage": qc.get("median_coverage"),
+            })
+    return rows
+
+
+def _variant_store_schema(samples):
+    import pyarrow as pa
+    schema = pa.schema([(name,getattr(pa,t)()) for name,t in VARIANT_STORE_COLUMNS])
+    # Keep the full list of samples so that samples without variants are not lost
+    return schema.with_metadata({"samples":json.dumps(samples)})
+
+
+def write_variant_store(filename,samples,records,batch_size=1000):
+    """
+    Write (sample, rows) records as returned by load_results(...,extract=get_variant_rows)
+    to a Parquet (.parquet) or Arrow IPC (any other extension) file.
+    """
+    import pyarrow as pa
+    schema = _variant_store_schema(samples)
+    if filename.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(filename,schema)
+    else:
+        writer = pa.ipc.new_file(filename,schema)
+
+    def flush(columns):
+        writer.write_table(pa.table(columns,schema=schema))
+
+    columns = {name:[] for name,t in VARIANT_STORE_COLUMNS}
+    for i,(s,rows) in enumerate(records):
+        for row in rows:
+            columns["sample_id"].append(s)
+            for name,t in VARIANT_STORE_COLUMNS[1:]:
+                columns[name].append(row[name])
+        if (i+1)%batch_size==0:
+            flush(columns)
+            columns = {name:[] for name,t in VARIANT_STORE_COLUMNS}
+    flush(columns)
+    writer.close()
+
+
+def read_variant_store(filename,columns=None):
+    """
+    Return (samples, table) where table is a pyarrow.Table with the
+    requested columns (all columns if None).
+    """
+    import pyarrow as pa
+    if filename.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        metadata = pq.read_schema(filename).metadata
+        table = pq.read_table(filename,columns=columns)
+    else:
+        table = pa.ipc.open_file(pa.memory_map(filename)).read_all()
+        metadata = table.schema.metadata
+        if columns:
+            table = table.select(columns)
+    samples = json.loads(metadata[b"samples"])
+    return samples,table
+
+
+# Result file schema migrations. Each upgrader converts a result dict from
+# one schema version to the next and is registered with register_migration.
+# migrate_result applies the chain of upgraders needed to reach a version.
+SCHEMA_VERSIONS = ["1","2","3.0","3.1"]
+_migrations = {}
+
+
+def register_migration(from_version,to_version):
+    def decorator(func):
+        _migrations[from_version] = (to_version,func)
+        return func
+    return decorator
+
+
+def detect_schema_version(data):
+    # v1 has a single list of variants, v2 has one dr_variant per drug, v3.0
+    # has a dict of drugs and v3.1 a list
+    if "variants" in data and "dr_variants" not in data:
+        return "1"
+    for var in data.get("dr_variants",[]):
+        if "drug" in var:
+            return "2"
+        if isinstance(var.get("drugs"),dict):
+            return "3.0"
+    return SCHEMA_VERSIONS[-1]
+
+
+def _freeze(value):
+    # Hashable version of a json value
+    if isinstance(value,dict):
+        return tuple((k,_freeze(v)) for k,v in value.items())
+    if isinstance(value,list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+@register_migration("1","2")
+def _upgrade_v1(data):
+    # Split the variants into dr_variants and other_variants and rename gene_id/gene_name
+    data["dr_variants"] = []
+    data["other_variants"] = []
+    for var in data.pop("variants"):
+        var = dict(var)
+        if "gene_id" in var:
+            var["locus_tag"] = var.pop("gene_id")
+        if "gene_name" in var:
+            var["gene"] = var.pop("gene_name")
+        var.setdefault("gene",var.get("locus_tag"))
+        data["dr_variants" if "drug" in var else "other_variants"].append(var)
+    return data
+
+
+@register_migration("2","3.0")
+def _upgrade_v2(data):
+    # Merge the per-drug copies of each variant into one variant with a dict of drugs
+    drug_keys = ["drug","confidence","literature"]
+    new_dr_variants = {}
+    for var in data["dr_variants"]:
+        tmp = {k:v for k,v in var.items() if k not in drug_keys}
+        key = _freeze(tmp)
+        if key not in new_dr_variants:
+            tmp["drugs"] = {}
+            new_dr_variants[key] = tmp
+        new_dr_variants[key]["drugs"][var["drug"]] = {k:var[k] for k in drug_keys[1:] if k in var}
+    data["dr_variants"] = list(new_dr_variants.values())
+    return data
+
+
+@register_migration("3.0","3.1")
+def _upgrade_v3_0(data):
+    for var in data["dr_variants"]:
+        if isinstance(var["drugs"],list): continue
+        var["drugs"] = [dict(drug=d,**var["drugs"][d]) for d in var["drugs"]]
+    return data
+
+
+def migrate_result(data,target=SCHEMA_VERSIONS[-1]):
+    """
+    Upgrade a result dict to the target schema version. Returns the data and
+    the version it was detected as.
+    """
+    version = detect_schema_version(data)
+    if SCHEMA_VERSIONS.index(version)>SCHEMA_VERSIONS.index(target):
+        raise ValueError("Can't downgrade from version %s to %s" % (version,target))
+    start_version = version
+    while version!=target:
+        version,func = _migrations[version][0],_migrations[version][1]
+        data = func(data)
+    return data,start_version
+
+
+_NORMALISED_KEYS = {"dr_variants","other_variants","variants"}
+
+
+class NormalisedResult(dict):
+    """
+    Result dict which presents a file of any schema version in the current
+    format, so scripts can run on directories with a mix of versions. The
+    variant lists are only converted the first time they are accessed; the
+    other fields are returned as they are in the file.
+    """
+    def __init__(self,data):
+        super().__init__(data)
+        self.schema_version = detect_schema_version(data)
+        self._normalised = self.schema_version==SCHEMA_VERSIONS[-1]
+
+    def _normalise(self):
+        if self._normalised: return
+        self._normalised = True
+        data,_ = migrate_result(dict(self))
+        self.clear()
+        self.update(data)
+
+    def __getitem__(self,key):
+        if key in _NORMALISED_KEYS:
+            self._normalise()
+        return super().__getitem__(key)
+
+    def get(self,key,default=None):
+        if key in _NORMALISED_KEYS:
+            self._normalise()
+        return super().get(key,default)
+
+    def __contains__(self,key):
+        if key in _NORMALISED_KEYS:
+            self._normalise()
+        return super().__contains__(key)
+
+    def __iter__(self):
+        self._normalise()
+        return super().__iter__()
+
+    def keys(self):
+        self._normalise()
+        return super().keys()
+
+    def items(self):
+        self._normalise()
+        return super().items()
+
+    def values(self):
+        self._normalise()
+        return super().values()
+
+
+def write_json_atomic(filename,data):
+    # Write to a temporary file and rename it so an interrupted run never leaves a partial file
+    tmp_file = "%s.tmp%s" % (filename,os.getpid())
+    with open(tmp_file,"w") as O:
+        json.dump(data,O)
+    os.replace(tmp_file,filename)
+
+
+def _migrate_worker(task):
+    in_file,out_file,target = task
+    try:
+        with open(in_file,"rb") as F:
+            data = parse_json(F.read())
+        version = detect_schema_version(data)
+        if version==target and os.path.abspath(in_file)==os.path.abspath(out_file):
+            return version,"up-to-date"
+        data,version = migrate_result(data,target)
+        write_json_atomic(out_file,data)
+        return version,"migrated"
+    except Exception as e:
+        # One bad file should not stop the other files from being migrated
+        sys.stderr.write("\nFailed to migrate %s: %s\n" % (in_file,repr(e)))
+        return None,"failed"
+
+
+def migrate_results(samples,in_dir,out_dir,suffix,target=SCHEMA_VERSIONS[-1],workers=1,overwrite=False):
+    """
+    Migrate the result files of samples from in_dir to out_dir (which may be
+    the same directory). Files in out_dir which are newer than the input are
+    assumed to be migrated already and are skipped unless overwrite is set.
+    Returns a dict with the number of files per status (migrated,
+    up-to-date, skipped or failed) and per original version.
+    """
+    from tqdm import tqdm
+    from collections import Counter
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    tasks = []
+    counts = Counter()
+    for s in samples:
+        in_file = filecheck("%s/%s%s" % (in_dir,s,suffix))
+        out_file = "%s/%s%s" % (out_dir,s,suffix)
+        if not overwrite and os.path.abspath(in_file)!=os.path.abspath(out_file) and os.path.isfile(out_file) and os.path.getmtime(out_file)>=os.path.getmtime(in_file):
+            counts["skipped"] += 1
+            continue
+        tasks.append((in_file,out_file,target))
+
+    if workers<=1:
+        results = map(_migrate_worker,tasks)
+    else:
+        pool = get_mp_context().Pool(workers)
+        results = pool.imap_unordered(_migrate_worker,tasks,chunksize=max(1,min(64,len(tasks)//(workers*8))))
+    for version,status in tqdm(results,total=len(tasks)):
+        counts[status] += 1
+        if version:
+            counts["from v%s" % version] += 1
+    if workers>1:
+        pool.close()
+        pool.join()
+    return counts
+
+
+def add_migration_args(parser,default_out_dir):
+    parser.add_argument('--samples',type=str,help='File with samples')
+    parser.add_argument('--in-dir',default="results/",type=str,help='Directory containing results')
+    parser.add_argument('--out-dir',default=default_out_dir,type=str,help='Directory for the migrated results (can be the same as --in-dir)')
+    parser.add_argument('--db',default="tbdb",type=str,help='Deprecated: the migration does not use the database, accepted so that existing command lines still work')
+    parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+    parser.add_argument('--overwrite',action="store_true",help='Migrate files which are already present in the output directory')
+    parser.add_argument('--workers',default=1,type=int,help='Number of processes used to migrate the result files')
+
+
+# Drug resistance classification. Each scheme is a column name, a list of
+# (label, rule) pairs checked in order and the label used when no rule
+# matches. The rules are functions of the boolean resistance masks returned
+# by get_resistance_features so that all samples are classified at once.
+FLQ_DRUGS = ["moxifloxacin","levofloxacin","ciprofloxacin","ofloxacin"]
+SLI_DRUGS = ["amikacin","capreomycin","kanamycin"]
+GROUP_A_DRUGS = ["bedaquiline","linezolid"]
+
+DR_CLASS_SCHEMES = {
+    # Classes used before the 2021 WHO definitions
+    "class": ("dr-class",[
+        ("Sensitive", lambda f: ~f["any"]),
+        ("Pre-MDR", lambda f: f["rif"] ^ f["inh"]),
+        ("MDR", lambda f: f["rif"] & f["inh"] & ~f["flq"] & ~f["sli"]),
+        ("Pre-XDR", lambda f: f["rif"] & f["inh"] & (f["flq"] ^ f["sli"])),
+        ("XDR", lambda f: f["rif"] & f["inh"] & f["flq"] & f["sli"]),
+    ],"Other"),
+    "mdr_or_above": ("MDR",[
+        ("1", lambda f: f["rif"] & f["inh"]),
+    ],"0"),
+    # WHO 2021 definitions: pre-XDR is RR/MDR with FLQ resistance and XDR also
+    # needs resistance to bedaquiline or linezolid
+    "who2021": ("who2021",[
+        ("Sensitive", lambda f: ~f["any"]),
+        ("XDR-TB", lambda f: f["rif"] & f["flq"] & f["group_a"]),
+        ("Pre-XDR-TB", lambda f: f["rif"] & f["flq"]),
+        ("MDR-TB", lambda f: f["rif"] & f["inh"]),
+        ("RR-TB", lambda f: f["rif"]),
+        ("HR-TB", lambda f: f["inh"]),
+    ],"Other"),
+}
+
+
+def get_resistant_drugs(data):
+    drugs = set()
+    for var in data["dr_variants"]:
+        for d in var["drugs"]:
+            drugs.add(d["drug"])
+    return sorted(drugs)
+
+
+def get_resistance_matrix(resistant_drugs):
+    """
+    Build a sample x drug boolean matrix from a list with the resistant drugs
+    of each sample. Returns (matrix, drugs).
+    """
+    import numpy as np
+    drugs = sorted(set(d for sample_drugs in resistant_drugs for d in sample_drugs))
+    drug_index = {d:i for i,d in enumerate(drugs)}
+    matrix = np.zeros((len(resistant_drugs),len(drugs)),dtype=bool)
+    rows = [i for i,sample_drugs in enumerate(resistant_drugs) for d in sample_drugs]
+    cols = [drug_index[d] for sample_drugs in resistant_drugs for d in sample_drugs]
+    matrix[rows,cols] = True
+    return matrix,drugs
+
+
+def get_resistance_features(matrix,drugs):
+    def any_of(group):
+        cols = [i for i,d in enumerate(drugs) if d in group]
+        return matrix[:,cols].any(axis=1)
+    return {
+        "any": matrix.any(axis=1),
+        "rif": any_of(["rifampicin"]),
+        "inh": any_of(["isoniazid"]),
+        "flq": any_of(FLQ_DRUGS),
+        "sli": any_of(SLI_DRUGS),
+        "group_a": any_of(GROUP_A_DRUGS),
+    }
+
+
+def assign_dr_classes(matrix,drugs,schemes):
+    # Returns {scheme: array of class labels}
+    import numpy as np
+    features = get_resistance_features(matrix,drugs)
+    classes = {}
+    for scheme in schemes:
+        column,rules,default = DR_CLASS_SCHEMES[scheme]
+        classes[scheme] = np.select([rule(features) for label,rule in rules],[label for label,rule in rules],default)
+    return classes
@@ -1,64 +1,12 @@
 #! /usr/bin/env python
 
-# Load useful libraries
-import json
-from collections import defaultdict
-import argparse
-import os
-from tqdm import tqdm
+# Kept for existing pipelines. This is tbprofiler_convert_to_v3.py (which
+# upgrades files from any older version) with new_results/ as the default
+# output directory.
 import sys
-import csv
-import pathogenprofiler as pp
-import tbprofiler
-
-
-def get_conf_dict(library_prefix):
-    files = {"gff":".gff","ref":".fasta","ann":".ann.txt","barcode":".barcode.bed","bed":".bed","json_db":".dr.json","version":".version.json"}
-    conf = {}
-    for key in files:
-        sys.stderr.write("Using %s file: %s\n" % (key,library_prefix+files[key]))
-        conf[key] = pp.filecheck(library_prefix+files[key])
-    return conf
-
-def main(args):
-    # Get a dictionary with the database file: {"ref": "/path/to/fasta" ... etc. }
-    conf = get_conf_dict(sys.base_prefix + "/share/tbprofiler/%s" % args.db)
-
-    # Get a dictionary mapping the locus_tags to drugs: {"Rv1484": ["isoniazid","ethionamide"], ... etc. }
-    locus_tag2drugs = tbprofiler.get_lt2drugs(conf["bed"])
-
-    # If a list of samples is supplied through the args object, store it in a list else get the list from looking in the results direcotry
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
-    else:
-        samples = [x.replace(args.suffix,"") for x in os.listdir(args.in_dir) if x[-len(args.suffix):]==args.suffix]
-
-    # Loop through the sample result files
-    for s in tqdm(samples):
-        # Data has the same structure as the .result.json files
-        data = json.load(open(pp.filecheck("%s/%s%s" % (args.in_dir,s,args.suffix))))
-        for var in data["dr_variants"]:
-            if isinstance(var["drugs"],list): continue
-            tmp1 = []
-            for d in var["drugs"]:
-                tmp2 = {}
-                tmp2["drug"] = d
-                for k in var["drugs"][d]:
-                    tmp2[k]  = var["drugs"][d][k]
-                tmp1.append(tmp2)
-            var["drugs"] = tmp1
-
-        json.dump(data,open("%s/%s%s" % (args.out_dir,s,args.suffix),"w"))
-
-
-# Set up the parser
-parser = argparse.ArgumentParser(description='tbprofiler script',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument('--samples',type=str,help='File with samples')
-parser.add_argument('--in-dir',default="results/",type=str,help='Directory containing results')
-parser.add_argument('--out-dir',default="new_results/",type=str,help='Directory containing results')
-parser.add_argument('--db',default="tbdb",type=str,help='Database name')
-parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
-parser.set_defaults(func=main)
+import os
+import runpy
 
-args = parser.parse_args()
-args.func(args)
+if not any(a=="--out-dir" or a.startswith("--out-dir=") for a in sys.argv[1:]):
+    sys.argv[1:1] = ["--out-dir","new_results/"]
+runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)),"tbprofiler_convert_to_v3.py"),run_name="__main__")
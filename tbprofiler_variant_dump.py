@@ -5,19 +5,14 @@ import json
 from collections import defaultdict
 import argparse
 import os
-from tqdm import tqdm
 import sys
 import csv
-import pathogenprofiler as pp
-import tbprofiler
+from tbprofiler_utils import get_samples, load_results, add_loader_args
 
 
 def main(args):
     # If a list of samples is supplied through the args object, store it in a list else get the list from looking in the results direcotry
-    if args.samples:
-        samples = [x.rstrip() for x in open(args.samples).readlines()]
-    else:
-        samples = [x.replace(args.suffix,"") for x in os.listdir(args.dir) if x[-len(args.suffix):]==args.suffix]
+    samples = get_samples(args.samples,args.dir,args.suffix)
 
     fields = ["sample_id","genome_pos","gene","change","freq","type","sublin","drtype","drugs"]
     with open(args.outfile,"w") as O:
@@ -25,9 +20,8 @@ def main(args):
         writer = csv.DictWriter(O,fieldnames=fields,delimiter=sep)
         writer.writeheader()
         # Loop through the sample result files
-        for s in tqdm(samples):
+        for s,data in load_results(samples,args.dir,args.suffix,workers=args.workers):
             # Data has the same structure as the .result.json files
-            data = json.load(open(pp.filecheck("%s/%s%s" % (args.dir,s,args.suffix))))
             for var in data["dr_variants"] + data['other_variants']:
                 var['sample_id'] = s
                 var['sublin'] = data['sublin']
@@ -46,6 +40,7 @@ parser.add_argument('--dir',default="results/",type=str,help='Directory containi
 parser.add_argument('--fmt',default="csv",choices=["csv","tsv"],type=str,help='Separator for fields')
 parser.add_argument('--db',default="tbdb",type=str,help='Database name')
 parser.add_argument('--suffix',default=".results.json",type=str,help='File suffix')
+add_loader_args(parser)
 parser.set_defaults(func=main)
 
 args = parser.parse_args()